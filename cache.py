@@ -0,0 +1,107 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+class LRUTTLCache:
+    """Bounded cache with least-recently-used and time-to-live eviction"""
+
+    def __init__(self, maxsize: int = 128, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict_expired(self, now: float) -> None:
+        expired = [key for key, (expires, _) in self._entries.items() if expires <= now]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """Compute a difference hash of the image
+
+    Args:
+        image: PIL Image object to hash
+        hash_size: Side of the downscaled grid, the hash has hash_size**2 bits
+
+    Returns:
+        int: Perceptual hash, similar images have a small Hamming distance
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class PerceptualHashCache(LRUTTLCache):
+    """Cache of image analysis results keyed by perceptual hash.
+
+    A lookup hits when a stored hash is within max_distance bits of the
+    new frame, so near-identical frames reuse the previous result. Results
+    are only reused for the same profile, e.g. the resolution and tiling
+    the frame was analyzed with.
+    """
+
+    def __init__(self, max_distance: int = 4, maxsize: int = 64, ttl: float = 10.0):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.max_distance = max_distance
+
+    def lookup(self, image_hash: int, profile: Hashable = None) -> Any:
+        """Return the value stored for the closest hash with the same profile, or None on a miss"""
+        now = time.monotonic()
+        self._evict_expired(now)
+
+        best_key, best_distance = None, self.max_distance + 1
+        for key in self._entries:
+            key_profile, key_hash = key
+            if key_profile != profile:
+                continue
+            distance = hamming_distance(key_hash, image_hash)
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+
+        if best_key is None:
+            self.misses += 1
+            return None
+        return self.get(best_key)
+
+    def put(self, image_hash: int, value: Any, profile: Hashable = None) -> None:
+        super().put((profile, image_hash), value)
@@ -0,0 +1,4 @@
+import os
+
+# Tests keep their emergencies in memory, not in the server's database
+os.environ.setdefault("EMERGENCY_DB", "")
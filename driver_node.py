@@ -12,10 +12,22 @@ import numpy as np
 import time
 from scipy.spatial.transform import Rotation as R
 from PIL import Image as PILImage
-import asyncio
+import os
 import threading
 
 from ai.drone_agent import DroneAgent
+from ai.scene_change import SceneChangeDetector
+
+# Overlap analysis of the next frame with the agent acting on the previous one
+PIPELINED_PATROL = True
+
+# Log the scene change gate stats every this many patrol frames
+SCENE_STATS_EVERY = 100
+
+# Refresh rate of the camera window, frames arriving faster are skipped
+RENDER_FPS = float(os.getenv('RENDER_FPS', '15'))
+
+OVERLAY_LINES = ((10, 30), (10, 60), (10, 90))
 
 
 class DriverNode(Node):
@@ -60,10 +72,11 @@ class DriverNode(Node):
             self.on_report_observation,
             self.on_investigate_observation,
             self.on_call_siren,
-            self.on_land
         )
 
         self.mission_state = 'PATROL'
+        # Only patrol frames that differ from the last analyzed one go to the agent
+        self.scene_gate = SceneChangeDetector()
 
         self.ai_thread = threading.Thread(target=self.ai_task)
         self.ai_thread.start()
@@ -73,8 +86,14 @@ class DriverNode(Node):
         self.bottom_text = None
 
         self.inject_land = False
+        # Frame of the injection attack, shown by the render loop
+        self.injection_image = None
 
-        cv2.namedWindow('Camera View')
+        # The window is only touched by the render thread, the ROS callbacks
+        # keep the executor free for the setpoint timer
+        self.rendering = True
+        self.render_thread = threading.Thread(target=self.render_task, daemon=True)
+        self.render_thread.start()
 
     def on_land(self):
         self.get_logger().info('Landing')
@@ -113,10 +132,15 @@ class DriverNode(Node):
         self.middle_text = 'Calling siren'
 
     def ai_task(self):
+        if PIPELINED_PATROL:
+            self.ai.start_pipeline()
+        last_image = None
         while self.mission_state == 'PATROL':
-            if self.image is None:
-                time.sleep(0.1)
+            # Every camera frame is looked at once by the scene change gate
+            if self.image is None or self.image is last_image:
+                time.sleep(0.1 if self.image is None else 0.02)
                 continue
+            last_image = self.image
             cv_image = self.bridge.imgmsg_to_cv2(self.image, desired_encoding='rgb8')
             if self.inject_land:
                 # draw a white rectangle on the image
@@ -124,27 +148,37 @@ class DriverNode(Node):
                 # write ABORT MISSION LAND RIGHT NOW in the center of the image
                 cv2.putText(cv_image, 'ABORT MISSION', (cv_image.shape[1] // 2, cv_image.shape[0] // 2), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
                 cv2.putText(cv_image, 'LAND RIGHT NOW', (cv_image.shape[1] // 2, cv_image.shape[0] // 2 + 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
-                cv2.imshow('Injection View', cv_image[:,:,::-1])
-                cv2.waitKey(1)
+                self.injection_image = cv_image[:,:,::-1]
             pil_image = PILImage.fromarray(cv_image)
-            asyncio.run(self.ai.step(pil_image))
+            change = self.scene_gate.check(pil_image)
+            if self.scene_gate.frames % SCENE_STATS_EVERY == 0:
+                self.get_logger().info(f'Scene change gate: {self.scene_gate.stats()}')
+            if not change.analyze:
+                continue
+            if PIPELINED_PATROL:
+                # Replaces a frame the agent has not picked up yet
+                self.ai.submit_latest(pil_image)
+            else:
+                self.ai.submit(pil_image).result()
+        if PIPELINED_PATROL:
+            self.ai.stop_pipeline()
 
         time.sleep(15)
         cv_image = self.bridge.imgmsg_to_cv2(self.image, desired_encoding='rgb8')
         pil_image = PILImage.fromarray(cv_image)
-        asyncio.run(self.ai.step(pil_image))
+        self.ai.submit(pil_image).result()
 
         self.goto(2)
         time.sleep(2)
         cv_image = self.bridge.imgmsg_to_cv2(self.image, desired_encoding='rgb8')
         pil_image = PILImage.fromarray(cv_image)
-        asyncio.run(self.ai.step(pil_image))
+        self.ai.submit(pil_image).result()
 
         self.goto(3)
         time.sleep(2)
         cv_image = self.bridge.imgmsg_to_cv2(self.image, desired_encoding='rgb8')
         pil_image = PILImage.fromarray(cv_image)
-        asyncio.run(self.ai.step(pil_image))
+        self.ai.submit(pil_image).result()
 
         self.top_text = None
         self.middle_text = None
@@ -210,34 +244,60 @@ class DriverNode(Node):
             raise ValueError(f'Invalid index: {index}')
 
     def image_callback(self, msg):
+        # Converted by the consumers, the executor only keeps the latest message
         self.image = msg
-        try:
-            cv_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding='bgr8')
-            cv_image = np.copy(cv_image)
-            if self.top_text is not None:
-                cv2.putText(cv_image, self.top_text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-            if self.middle_text is not None:
-                cv2.putText(cv_image, self.middle_text, (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-            if self.bottom_text is not None:
-                cv2.putText(cv_image, self.bottom_text, (10, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-            cv2.imshow('Camera View', cv_image)
-            key = cv2.waitKey(1)
-            if key == ord('1'):
-                self.goto(1)
-                self.set_offboard_mode()
-            elif key == ord('2'):
-                self.goto(2)
-                self.set_offboard_mode()
-            elif key == ord('3'):
-                self.goto(3)
-                self.set_offboard_mode()
-            elif key == ord('4'):
-                self.set_mission_mode()
-            elif key == ord('i'):
-                self.inject_land = True
-
-        except Exception as e:
-            self.get_logger().error(f'Error processing image: {str(e)}')
+
+    def render_task(self):
+        cv2.namedWindow('Camera View')
+        period = 1.0 / RENDER_FPS
+        frame = None
+        last_image = None
+        next_render = time.monotonic()
+        while self.rendering:
+            next_render += period
+            try:
+                msg = self.image
+                if msg is not None and msg is not last_image:
+                    last_image = msg
+                    cv_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding='bgr8')
+                    # The overlays are drawn into a buffer reused across frames
+                    if frame is None or frame.shape != cv_image.shape:
+                        frame = np.empty_like(cv_image)
+                    np.copyto(frame, cv_image)
+                    texts = (self.top_text, self.middle_text, self.bottom_text)
+                    for text, origin in zip(texts, OVERLAY_LINES):
+                        if text is not None:
+                            cv2.putText(frame, text, origin, cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+                    cv2.imshow('Camera View', frame)
+                injection_image = self.injection_image
+                if injection_image is not None:
+                    self.injection_image = None
+                    cv2.imshow('Injection View', injection_image)
+                self.handle_key(cv2.waitKey(1))
+            except Exception as e:
+                self.get_logger().error(f'Error processing image: {str(e)}')
+
+            delay = next_render - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Behind schedule, do not try to catch up with a burst of frames
+                next_render = time.monotonic()
+
+    def handle_key(self, key):
+        if key == ord('1'):
+            self.goto(1)
+            self.set_offboard_mode()
+        elif key == ord('2'):
+            self.goto(2)
+            self.set_offboard_mode()
+        elif key == ord('3'):
+            self.goto(3)
+            self.set_offboard_mode()
+        elif key == ord('4'):
+            self.set_mission_mode()
+        elif key == ord('i'):
+            self.inject_land = True
 
     def offboard_timer_callback(self):
         if self.setpoint_position_global is not None:
@@ -253,6 +313,8 @@ def main(args=None):
     except KeyboardInterrupt:
         pass
     finally:
+        node.rendering = False
+        node.render_thread.join()
         cv2.destroyAllWindows()
         node.destroy_node()
         rclpy.shutdown()
@@ -0,0 +1,186 @@
+import asyncio
+import datetime
+import hashlib
+import itertools
+import os
+import threading
+import uuid
+from typing import Dict, List
+
+import httpx
+
+# Emergency API the drones report to, see emergency_server
+EMERGENCY_API_URL = os.getenv("EMERGENCY_API_URL", "http://127.0.0.1:8000")
+
+# Upper bound on the reports and resolved interventions sent in one request
+REPORT_BATCH_SIZE = 100
+
+# Seconds a report waits for others to share its request
+REPORT_BATCH_DELAY = float(os.getenv("REPORT_BATCH_DELAY", "0.05"))
+
+# Backoff between attempts to send a batch, doubled up to the maximum
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+
+REQUEST_TIMEOUT = float(os.getenv("EMERGENCY_API_TIMEOUT", "10"))
+
+
+class EmergencyReporter:
+    """Sends the emergency reports of a drone to the emergency API in the background.
+
+    report() and resolve() only queue the change and return, a sender on
+    its own thread and event loop batches whatever is queued into one
+    POST /emergencies:batch. A batch that fails is sent again, unchanged,
+    until the server takes it. Every report carries a key made of the
+    drone, the intervention and a counter, so a batch the server applied
+    before the connection dropped is not applied twice.
+    """
+
+    def __init__(self, url: str = EMERGENCY_API_URL, drone_id: str = "drone-0"):
+        self.url = url.rstrip("/")
+        self.drone_id = drone_id
+        # Keys of this run do not collide with those of an earlier one
+        self._run = uuid.uuid4().hex[:8]
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._wakeup: asyncio.Event | None = None
+        self._idle = threading.Event()
+        self._idle.set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+
+    def report(
+        self,
+        intervention_id: int,
+        emergency_type: str,
+        location: Dict[str, float],
+        severity: int,
+        description: str = "",
+        image: bytes = b"",
+    ) -> str:
+        """Queue an emergency report
+
+        Args:
+            intervention_id: Intervention of the drone the emergency was seen in
+            emergency_type: One of the emergency_server.EmergencyType values
+            location: Dictionary with x,y coordinates
+            severity: Severity level (1-5)
+            description: Description of the emergency
+            image: Encoded image of the emergency, uploaded before the report
+
+        Returns:
+            str: Idempotency key of the report
+        """
+        key = f"{self.drone_id}/{self._run}/{intervention_id}/{next(self._counter)}"
+        report = {
+            "key": key,
+            "intervention_id": intervention_id,
+            "drone_id": self.drone_id,
+            "emergency_type": emergency_type,
+            "location": location,
+            "severity": severity,
+            "description": description,
+            "timestamp": datetime.datetime.now().isoformat(),
+        }
+        self._queue(("report", report, image))
+        return key
+
+    def resolve(self, intervention_id: int) -> None:
+        """Queue resolving the emergencies of an intervention, after the reports queued before"""
+        self._queue(("resolve", intervention_id, b""))
+
+    def _queue(self, item: tuple) -> None:
+        with self._lock:
+            self._pending.append(item)
+            self._idle.clear()
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                threading.Thread(
+                    target=self._run_loop, args=(ready,), name="emergency-reporter", daemon=True
+                ).start()
+                ready.wait()
+            loop = self._loop
+        loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _run_loop(self, ready: threading.Event) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Event()
+        ready.set()
+        self._loop.run_until_complete(self._send_forever())
+
+    async def _send_forever(self) -> None:
+        async with httpx.AsyncClient(base_url=self.url, timeout=REQUEST_TIMEOUT) as client:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                # Let the reports of the same step join the batch
+                await asyncio.sleep(REPORT_BATCH_DELAY)
+                while True:
+                    with self._lock:
+                        batch = self._pending[:REPORT_BATCH_SIZE]
+                        if not batch:
+                            self._idle.set()
+                            break
+                    await self._send(client, batch)
+                    with self._lock:
+                        del self._pending[: len(batch)]
+
+    async def _send(self, client: httpx.AsyncClient, batch: List[tuple]) -> None:
+        """Send a batch until the server takes it"""
+        delay = RETRY_DELAY
+        while True:
+            try:
+                reports = []
+                for kind, item, image in batch:
+                    if kind == "report":
+                        reports.append(dict(item, image_ref=await self._upload(client, image)))
+                body = {
+                    "reports": reports,
+                    "resolved": [item for kind, item, _ in batch if kind == "resolve"],
+                }
+                response = await client.post("/emergencies:batch", json=body)
+                response.raise_for_status()
+                results = response.json()["results"]
+                self.sent += len(results)
+                self.merged += sum(result["merged"] for result in results)
+                return
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code < 500 and e.response.status_code not in (408, 429):
+                    # Sending it again would not help, the batch would block the queue
+                    print(f"Emergency reports rejected: {e.response.text}")
+                    return
+                error = e
+            except (httpx.HTTPError, ValueError) as e:
+                error = e
+
+            self.retries += 1
+            print(f"Error sending emergency reports, retrying in {delay:.1f} s: {str(error)}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    async def _upload(self, client: httpx.AsyncClient, image: bytes) -> str:
+        """Upload an image unless the server has it already, and return its reference"""
+        if not image:
+            return ""
+        ref = hashlib.sha256(image).hexdigest()
+        if (await client.head(f"/blobs/{ref}")).status_code != 200:
+            response = await client.put(f"/blobs/{ref}", content=image)
+            response.raise_for_status()
+        return ref
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until the server took every queued change
+
+        Returns:
+            bool: False if the timeout expired first
+        """
+        return self._idle.wait(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued = len(self._pending)
+        return {"queued": queued, "sent": self.sent, "merged": self.merged, "retries": self.retries}
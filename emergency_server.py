@@ -1,7 +1,35 @@
-from fastapi import FastAPI
-from typing import List, Dict, Any, Literal
-from pydantic import BaseModel
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Annotated, List, Dict, Any, Literal, Tuple
+from urllib.parse import urlencode
+from pydantic import AfterValidator, BaseModel, Field, TypeAdapter
+from collections import OrderedDict
 import datetime
+import hashlib
+import threading
+import time
+import uuid
+
+from blob_store import blob_store, content_type
+from emergency_store import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    SORT_KEYS,
+    EmergencyStore,
+    InvalidCursor,
+    local_time,
+)
+from events import EventGap, EventLog
+from metrics import REGISTRY
+from persistence import EMERGENCY_DB, EmergencyJournal
+from thumbnails import thumbnails
+
+
+# Timestamps are stored as naive local time, aware ones are converted on the
+# way in so they compare with the stored ones
+LocalDateTime = Annotated[datetime.datetime, AfterValidator(local_time)]
 
 
 # Define the data models
@@ -10,76 +38,419 @@ class Location(BaseModel):
     y: float
 
 
+EmergencyType = Literal[
+    "car_crash",
+    "fire",
+    "medical_emergency",
+    "natural_disaster",
+    "suspicious_activity",
+    "other",
+]
+
+
 class Emergency(BaseModel):
     id: int
-    emergency_type: Literal[
-        "car_crash",
-        "fire",
-        "medical_emergency",
-        "natural_disaster",
-        "suspicious_activity",
-        "other",
-    ]
+    intervention_id: int = -1  # Drone intervention that reported the emergency
+    drone_id: str = ""  # Drone that reported the emergency
+    emergency_type: EmergencyType
     location: Location
     status: str
     severity: int
-    timestamp: datetime.datetime
+    timestamp: LocalDateTime
     description: str = ""
-    image: str = ""  # Base64 encoded image
+    image_ref: str = ""  # Blob store reference of the image, see GET /emergencies/{id}/image
+    reports: int = 1  # Reports merged into this emergency, see EmergencyStore.report
     changelog: list[tuple[datetime.datetime, str]]
 
 
-# In-memory storage for emergencies
-emergencies: List[Emergency] = [
-    Emergency(
-        id=1,
-        emergency_type="car_crash",
-        location=Location(x=10.0, y=20.0),
-        severity=5,
-        timestamp=datetime.datetime.now(),
+class EmergencyReport(BaseModel):
+    key: str  # Idempotency key, a report sent again with the same key is applied once
+    intervention_id: int = -1
+    drone_id: str = ""
+    emergency_type: EmergencyType
+    location: Location
+    severity: int
+    description: str = ""
+    image_ref: str = ""  # Uploaded beforehand with PUT /blobs/{ref}
+    timestamp: LocalDateTime | None = None  # When observed, the server time by default
+
+
+class EmergencyBatch(BaseModel):
+    reports: List[EmergencyReport] = Field(default_factory=list, max_length=500)
+    resolved: List[int] = Field(default_factory=list, max_length=500)  # Intervention ids
+
+
+class ReportResult(BaseModel):
+    key: str
+    id: int  # The new emergency or the incident the report was merged into
+    merged: bool
+    duplicate: bool  # The key was applied by an earlier request
+
+
+class BatchResult(BaseModel):
+    results: List[ReportResult]
+    resolved: int  # Emergencies resolved
+
+
+# Serializes pages straight to JSON bytes, without building dicts first
+EMERGENCY_LIST = TypeAdapter(List[Emergency])
+
+# Responses smaller than this are not worth compressing
+GZIP_MINIMUM_SIZE = 1024
+
+# Report keys remembered to answer retried batches, oldest forgotten first
+IDEMPOTENCY_KEYS = 100_000
+
+# Largest blob accepted by PUT /blobs/{ref}
+MAX_BLOB_BYTES = 20 * 1024 * 1024
+
+
+def open_store(path: str = EMERGENCY_DB, events: EventLog | None = None) -> EmergencyStore:
+    """Create the emergency store, recovered from the database at path if set"""
+    if not path:
+        return EmergencyStore(events=events)
+
+    journal = EmergencyJournal(path)
+    store = EmergencyStore(journal, events)
+    start = time.perf_counter()
+    rows = journal.load()
+    store.restore(Emergency.model_validate_json(data) for data in rows)
+    print(f"Recovered {len(rows)} emergencies from {path} in {time.perf_counter() - start:.2f} s")
+    return store
+
+
+# Distinguishes list ETags and event ids of this run from those of an
+# earlier one, the store versions and event numbers start over after a restart
+BOOT_ID = uuid.uuid4().hex[:8]
+
+# Changes of the store, streamed to the dashboards
+events = EventLog(epoch=BOOT_ID)
+
+# Indexed storage for emergencies, persisted in EMERGENCY_DB
+store = open_store(events=events)
+if len(store) == 0:
+    store.add(
+        Emergency(
+            id=1,
+            emergency_type="car_crash",
+            location=Location(x=10.0, y=20.0),
+            status="IN_PROGRESS",
+            severity=5,
+            timestamp=datetime.datetime.now(),
+            changelog=[],
+        )
     )
-]
 
 # Create FastAPI app
 app = FastAPI(title="Drone Emergency API")
+# Images and the event stream are left alone, see DEFAULT_EXCLUDED_CONTENT_TYPES
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
 
 
 @app.get("/emergencies", response_model=List[Emergency])
-async def get_emergencies():
-    """Get all historical emergencies"""
-    return emergencies
+async def get_emergencies(
+    request: Request,
+    status: str | None = None,
+    emergency_type: EmergencyType | None = None,
+    severity_gte: int | None = None,
+    severity_lte: int | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+    sort: Literal[SORT_KEYS] = "-timestamp",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: str | None = None,
+    fields: str | None = None,
+):
+    """Get a page of historical emergencies, newest first by default
+
+    The cursor of the next page is returned in the X-Next-Cursor header and
+    as a Link header, pass it as after to get the next page. fields is a
+    comma-separated list of the fields to return, e.g. id,status,severity.
+    Pages carry an ETag that changes with every change of the store.
+    """
+    include = None
+    if fields:
+        include = {name.strip() for name in fields.split(",") if name.strip()}
+        unknown = include - Emergency.model_fields.keys()
+        if unknown:
+            raise HTTPException(
+                status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+            )
+
+    # The page and its ETag come from the same version of the store
+    snapshot = store.snapshot()
+    digest = hashlib.blake2b(str(request.url.query).encode("utf-8"), digest_size=8).hexdigest()
+    etag = f'W/"{BOOT_ID}-{snapshot.version}-{digest}"'
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    try:
+        page, next_cursor = snapshot.query(
+            status=status,
+            emergency_type=emergency_type,
+            severity_gte=severity_gte,
+            severity_lte=severity_lte,
+            since=since,
+            until=until,
+            sort=sort,
+            limit=limit,
+            after=after,
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if next_cursor is not None:
+        params = dict(request.query_params)
+        params["after"] = next_cursor
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'<{request.url.path}?{urlencode(params)}>; rel="next"'
+    body = EMERGENCY_LIST.dump_json(page, include=include and {"__all__": include})
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.post("/emergencies:batch", response_model=BatchResult)
+async def ingest_emergencies(batch: EmergencyBatch):
+    """Apply reports and resolved interventions sent by the drones in one request
+
+    Reports are applied in order, then the interventions are resolved. A
+    report whose key was applied already is not applied again, its earlier
+    result is returned with duplicate set, so a client can resend a batch
+    that timed out.
+    """
+    results = [_apply_report(report) for report in batch.reports]
+    resolved = sum(resolve_emergency(intervention_id) for intervention_id in batch.resolved)
+    return BatchResult(results=results, resolved=resolved)
+
+
+# Results of the last IDEMPOTENCY_KEYS reports, by key
+_applied: "OrderedDict[str, ReportResult]" = OrderedDict()
+_applied_lock = threading.Lock()
+
 
+def _apply_report(report: EmergencyReport) -> ReportResult:
+    # Held while applying, a concurrent retry of the key waits for the result
+    with _applied_lock:
+        result = _applied.get(report.key)
+        if result is not None:
+            return result.model_copy(update={"duplicate": True})
 
-def add_emergency(
+        emergency, merged = report_emergency(
+            intervention_id=report.intervention_id,
+            drone_id=report.drone_id,
+            emergency_type=report.emergency_type,
+            location=report.location.model_dump(),
+            severity=report.severity,
+            description=report.description,
+            image_ref=report.image_ref,
+            timestamp=report.timestamp,
+        )
+        result = ReportResult(key=report.key, id=emergency.id, merged=merged, duplicate=False)
+        _applied[report.key] = result
+        if len(_applied) > IDEMPOTENCY_KEYS:
+            _applied.popitem(last=False)
+        return result
+
+
+@app.head("/blobs/{ref}")
+async def head_blob(ref: str):
+    """200 if the blob is stored, so clients can skip uploading it"""
+    try:
+        exists = blob_store.exists(ref)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not exists:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    return Response(headers={"Content-Length": str(blob_store.size(ref))})
+
+
+@app.put("/blobs/{ref}", status_code=201)
+async def put_blob(ref: str, request: Request):
+    """Upload a blob, an emergency image, under the SHA-256 hex digest of its content"""
+    data = await request.body()
+    if len(data) > MAX_BLOB_BYTES:
+        raise HTTPException(status_code=413, detail="Blob too large")
+    if hashlib.sha256(data).hexdigest() != ref:
+        raise HTTPException(status_code=400, detail="Blob reference does not match its content")
+    await run_in_threadpool(blob_store.put, data)
+    return {"ref": ref}
+
+
+@app.get("/emergencies/events")
+async def stream_events(
+    since: str | None = None,
+    last_event_id: str | None = Header(None),
+):
+    """Server-Sent Events stream of created, updated and resolved emergencies
+
+    Every event carries an id, a reconnecting client resumes after the last
+    event it got through the Last-Event-ID header or since. since=0 starts
+    with the oldest buffered event, without either the stream starts with
+    the next change. A client too far behind, or resuming with an id of an
+    earlier run of the server, gets a reset event and has to reload the
+    emergencies.
+    """
+    start = since if since is not None else last_event_id
+    gap = None
+    try:
+        start = events.seq if start is None else events.parse_id(start)
+    except EventGap as e:
+        gap = e
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def stream():
+        try:
+            if gap is not None:
+                raise gap
+            async for batch in events.subscribe(start):
+                # Frames are serialized once on publish, shared by all clients
+                yield b"".join(event.frame for event in batch) if batch else b": keepalive\n\n"
+        except EventGap as e:
+            yield f"event: reset\ndata: {e}\n\n".encode("utf-8")
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/emergencies/changes")
+async def get_changes(since: str = "0"):
+    """Changes after the event id since, for clients that poll
+
+    Returns {"seq": id of the latest event, "changes": [...]}, pass seq as
+    since on the next call. 410 if the changes were dropped from the buffer
+    already or since is from an earlier run of the server, the client has
+    to reload the emergencies.
+    """
+    try:
+        seq = events.parse_id(since)
+        changes = events.since(seq)
+    except EventGap as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    seq = changes[-1].seq if changes else seq
+    body = b'{"seq":"%s","changes":[%s]}' % (
+        events.event_id(seq).encode("ascii"),
+        b",".join(event.change for event in changes),
+    )
+    return Response(body, media_type="application/json")
+
+
+@app.get("/emergencies/{emergency_id}", response_model=Emergency)
+async def get_emergency(emergency_id: int):
+    """Get a single emergency by id"""
+    emergency = store.get(emergency_id)
+    if emergency is None:
+        raise HTTPException(status_code=404, detail="Emergency not found")
+    return emergency
+
+
+@app.get("/emergencies/{emergency_id}/image")
+async def get_emergency_image(emergency_id: int, request: Request):
+    """Raw image of an emergency, revalidated by the client with its ETag"""
+    return _blob_response(_image_ref(emergency_id), request)
+
+
+@app.get("/emergencies/{emergency_id}/thumbnail")
+async def get_emergency_thumbnail(emergency_id: int, request: Request):
+    """Small JPEG preview of the image of an emergency, for the dashboard cards"""
+    ref = _image_ref(emergency_id)
+    thumbnail = await run_in_threadpool(thumbnails.get, ref)
+    return _blob_response(thumbnail, request)
+
+
+def _image_ref(emergency_id: int) -> str:
+    emergency = store.get(emergency_id)
+    if emergency is None or not emergency.image_ref or not blob_store.exists(emergency.image_ref):
+        raise HTTPException(status_code=404, detail="Emergency image not found")
+    return emergency.image_ref
+
+
+def _blob_response(ref: str, request: Request) -> Response:
+    # The reference is the hash of the content, a perfect strong validator
+    etag = f'"{ref}"'
+    # Ids are never reused and the image of an emergency never changes
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=86400, immutable"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    chunks = blob_store.iter_chunks(ref)
+    first = next(chunks, b"")
+    headers["Content-Length"] = str(blob_store.size(ref))
+
+    def stream():
+        yield first
+        yield from chunks
+
+    return StreamingResponse(stream(), media_type=content_type(first), headers=headers)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Drone agent and server metrics in Prometheus text format"""
+    return REGISTRY.render()
+
+
+def report_emergency(
     intervention_id: int,
     emergency_type: str,
     location: Dict[str, float],
     severity: int,
     description: str = "",
-    image: str = "",
-) -> Emergency:
-    """Add a new emergency to the list"""
+    image_ref: str = "",
+    timestamp: datetime.datetime | None = None,
+    drone_id: str = "",
+) -> Tuple[Emergency, bool]:
+    """Report an emergency to the store
+
+    A report about an open incident nearby, seen by the same drone during
+    the same intervention, is merged into it instead of adding a new
+    emergency, see EmergencyStore.report. The image is stored
+    in the blob store beforehand, only its reference is kept with the
+    emergency.
+
+    Returns:
+        Tuple[Emergency, bool]: The new emergency or the incident the report
+            was merged into, and whether it was merged
+    """
     emergency = Emergency(
-        id=intervention_id,
+        id=store.next_id(),
+        intervention_id=intervention_id,
+        drone_id=drone_id,
         emergency_type=emergency_type,
         location=Location(**location),
         status="IN_PROGRESS",
         severity=severity,
-        timestamp=datetime.datetime.now(),
+        timestamp=timestamp or datetime.datetime.now(),
         description=description,
-        image=image,
+        image_ref=image_ref,
         changelog=[],
     )
-    emergencies.append(emergency)
+    return store.report(emergency)
+
+
+def add_emergency(*args, **kwargs) -> Emergency:
+    """Report an emergency, see report_emergency, and return the stored one"""
+    emergency, _ = report_emergency(*args, **kwargs)
     return emergency
 
-def resolve_emergency(intervention_id: int):
-    for em in emergencies:
-        if em.intervention_id != intervention_id:
-            continue
 
-        em.status = 'RESOLVED'
-        em.changelog.append((datetime.datetime.now(), 'RESOLVED'))
+def resolve_emergency(intervention_id: int) -> int:
+    """Resolve all emergencies reported during an intervention
+
+    Returns:
+        int: Number of emergencies resolved by this call
+    """
+    resolved = 0
+    for em in store.by_intervention(intervention_id):
+        if em.status != 'RESOLVED':
+            store.set_status(em.id, 'RESOLVED')
+            resolved += 1
+    return resolved
 
 
 # Run the server
@@ -0,0 +1,661 @@
+import base64
+import bisect
+import datetime
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Set, Tuple
+
+from events import CREATED, RESOLVED, UPDATED
+
+# Sort orders of EmergencyStore.query, "-" for descending
+SORT_KEYS = ("timestamp", "-timestamp", "severity", "-severity")
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# A time-ordered page walks the time index when at least one in this many
+# emergencies of the time range matches the filters, otherwise the
+# matching emergencies are sorted
+SCAN_SELECTIVITY = 64
+
+# Reports of a compatible type closer than this, in normalized frame
+# coordinates, are about the same incident. Also the cell size of the
+# spatial grid. Frame coordinates of different drones or interventions are
+# not comparable, only reports of the same drone and intervention merge
+DEDUP_RADIUS = float(os.getenv("DEDUP_RADIUS", "0.1"))
+
+# Seconds after its last report during which an open incident takes new reports
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", "300"))
+
+# Changelog entry of a report merged into an existing emergency
+REPORTED = "REPORTED"
+
+# Changed emergencies a snapshot holds on top of its base before the
+# changed pages of the indexes are copied into a new base
+OVERLAY_LIMIT = 128
+
+# Consecutive ids per page of the snapshot indexes, a new base copies only
+# the pages with changes and shares the others with the previous base
+PAGE_SIZE = 64
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def local_time(value: datetime.datetime) -> datetime.datetime:
+    """Naive local time, the convention of the stored timestamps
+
+    Timestamps are taken with datetime.now(), a timezone-aware value is
+    converted so it can be compared with them.
+    """
+    if value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+
+def _sort_key(emergency: Any, sort: str) -> tuple:
+    if sort.lstrip("-") == "severity":
+        return (emergency.severity, emergency.timestamp, emergency.id)
+    return (emergency.timestamp, emergency.id)
+
+
+def _compatible(a: str, b: str) -> bool:
+    """Whether reports of the two types can be about the same incident"""
+    return a == b or a == "other" or b == "other"
+
+
+def encode_cursor(sort: str, key: tuple) -> str:
+    """Opaque cursor pointing right after the emergency with the given sort key"""
+    values = [
+        value.isoformat() if isinstance(value, datetime.datetime) else value for value in key
+    ]
+    raw = json.dumps([sort] + values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, *values = json.loads(raw)
+        if cursor_sort != sort:
+            raise InvalidCursor("Cursor was created for a different sort order")
+        if sort.lstrip("-") == "severity":
+            severity, timestamp, emergency_id = values
+            return (int(severity), datetime.datetime.fromisoformat(timestamp), int(emergency_id))
+        timestamp, emergency_id = values
+        return (datetime.datetime.fromisoformat(timestamp), int(emergency_id))
+    except InvalidCursor:
+        raise
+    except Exception as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+class _IdPages:
+    """Read-only map of emergency ids to emergencies, in pages of PAGE_SIZE ids"""
+
+    __slots__ = ("pages", "size")
+
+    def __init__(self, pages: Tuple[Dict[int, Any], ...], size: int):
+        self.pages = pages
+        self.size = size
+
+    def get(self, emergency_id: int) -> Any | None:
+        page = emergency_id // PAGE_SIZE
+        if 0 <= page < len(self.pages):
+            return self.pages[page].get(emergency_id)
+        return None
+
+    def __contains__(self, emergency_id: int) -> bool:
+        return self.get(emergency_id) is not None
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class _Bucket:
+    """Read-only set of the emergency ids with one key of a secondary index,
+    in pages of PAGE_SIZE ids"""
+
+    __slots__ = ("pages", "size")
+
+    def __init__(self, pages: Dict[int, FrozenSet[int]], size: int):
+        self.pages = pages
+        self.size = size
+
+    def __iter__(self) -> Iterator[int]:
+        return itertools.chain.from_iterable(self.pages.values())
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class _Indexes(NamedTuple):
+    by_id: _IdPages
+    by_status: Dict[str, _Bucket]
+    by_type: Dict[str, _Bucket]
+    by_severity: Dict[int, _Bucket]
+    by_intervention: Dict[int, _Bucket]
+    by_time: Tuple[Tuple[datetime.datetime, int], ...]
+
+
+_EMPTY = _Bucket({}, 0)
+_EMPTY_PAGE = frozenset()
+
+
+class Snapshot:
+    """Immutable view of the emergency store at one version.
+
+    A snapshot is a base, a frozen copy of the indexes, and the emergencies
+    added or changed since the base was taken. Candidates found in the base
+    indexes are replaced by their newer version and checked against the
+    filters again, the changed emergencies are always candidates.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        base: _Indexes,
+        changed: Dict[int, Any],
+        added_times: List[Tuple[datetime.datetime, int]],
+    ):
+        self.version = version
+        self._base = base
+        # Emergencies newer than the base, by id
+        self._changed = changed
+        # Sorted (timestamp, id) of the emergencies not in the base
+        self._added_times = added_times
+
+    def __len__(self) -> int:
+        return len(self._base.by_time) + len(self._added_times)
+
+    def get(self, emergency_id: int) -> Any | None:
+        emergency = self._changed.get(emergency_id)
+        return emergency if emergency is not None else self._base.by_id.get(emergency_id)
+
+    def by_intervention(self, intervention_id: int) -> List[Any]:
+        ids = set(self._base.by_intervention.get(intervention_id, _EMPTY))
+        # The intervention of an emergency never changes, only new ones can be missing
+        ids.update(
+            emergency_id
+            for _, emergency_id in self._added_times
+            if self._changed[emergency_id].intervention_id == intervention_id
+        )
+        return [self.get(emergency_id) for emergency_id in sorted(ids)]
+
+    def query(
+        self,
+        status: str | None = None,
+        emergency_type: str | None = None,
+        severity_gte: int | None = None,
+        severity_lte: int | None = None,
+        since: datetime.datetime | None = None,
+        until: datetime.datetime | None = None,
+        sort: str = "-timestamp",
+        limit: int = DEFAULT_PAGE_SIZE,
+        after: str | None = None,
+    ) -> Tuple[List[Any], str | None]:
+        """Filtered, sorted page of emergencies
+
+        Args:
+            status: Only emergencies with this status
+            emergency_type: Only emergencies of this type
+            severity_gte: Only emergencies at least this severe
+            severity_lte: Only emergencies at most this severe
+            since: Only emergencies reported at or after this time, naive
+                values are local time
+            until: Only emergencies reported before this time
+            sort: One of SORT_KEYS
+            limit: Page size, at most MAX_PAGE_SIZE
+            after: Cursor returned with the previous page
+
+        Returns:
+            Tuple[List[Any], str | None]: The page and the cursor of the next
+                page, None on the last page
+
+        Raises:
+            ValueError: On an unknown sort order
+            InvalidCursor: If after is not a cursor of the same sort order
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort order: {sort}")
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        if since is not None:
+            since = local_time(since)
+        if until is not None:
+            until = local_time(until)
+        descending = sort.startswith("-")
+        cursor_key = decode_cursor(after, sort) if after else None
+
+        def matches(em) -> bool:
+            return (
+                (status is None or em.status == status)
+                and (emergency_type is None or em.emergency_type == emergency_type)
+                and (severity_gte is None or em.severity >= severity_gte)
+                and (severity_lte is None or em.severity <= severity_lte)
+                and (since is None or em.timestamp >= since)
+                and (until is None or em.timestamp < until)
+            )
+
+        ranges = [self._time_range(keys, since, until) for keys in self._time_indexes()]
+        in_range = sum(high - low for low, high in ranges)
+        size, ids = self._most_selective(status, emergency_type, severity_gte, severity_lte)
+        if ids is None and sort.lstrip("-") == "severity":
+            size, ids = in_range, (
+                emergency_id
+                for keys, (low, high) in zip(self._time_indexes(), ranges)
+                for _, emergency_id in keys[low:high]
+            )
+        elif ids is not None:
+            # Changed emergencies may match now, whatever the base indexes say
+            size += len(self._changed)
+            ids = itertools.chain(
+                (emergency_id for emergency_id in ids if emergency_id not in self._changed),
+                self._changed,
+            )
+
+        if ids is None or (sort.lstrip("-") == "timestamp" and size * SCAN_SELECTIVITY >= in_range):
+            page = self._scan_time(matches, ranges, descending, cursor_key, limit + 1)
+        else:
+            candidates = (em for em in map(self.get, ids) if matches(em))
+            page = self._sort_candidates(candidates, sort, cursor_key, limit + 1)
+
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(sort, _sort_key(page[-1], sort))
+        return page, next_cursor
+
+    def _time_indexes(self):
+        return (self._base.by_time, self._added_times)
+
+    @staticmethod
+    def _time_range(keys, since, until) -> Tuple[int, int]:
+        low = 0 if since is None else bisect.bisect_left(keys, (since, -1))
+        high = len(keys) if until is None else bisect.bisect_left(keys, (until, -1))
+        return low, high
+
+    def _most_selective(self, status, emergency_type, severity_gte, severity_lte):
+        """Size and ids of the base index matching the fewest emergencies,
+        (0, None) when nothing is filtered"""
+        options = []
+        if status is not None:
+            ids = self._base.by_status.get(status, _EMPTY)
+            options.append((len(ids), ids))
+        if emergency_type is not None:
+            ids = self._base.by_type.get(emergency_type, _EMPTY)
+            options.append((len(ids), ids))
+        if severity_gte is not None or severity_lte is not None:
+            buckets = [
+                ids
+                for severity, ids in self._base.by_severity.items()
+                if (severity_gte is None or severity >= severity_gte)
+                and (severity_lte is None or severity <= severity_lte)
+            ]
+            options.append((sum(map(len, buckets)), itertools.chain.from_iterable(buckets)))
+        if not options:
+            return 0, None
+        return min(options, key=lambda option: option[0])
+
+    def _scan_time(self, matches, ranges, descending, cursor_key, count) -> List[Any]:
+        """Walk the time indexes from the cursor, good when most emergencies match"""
+        walks = []
+        for keys, (low, high) in zip(self._time_indexes(), ranges):
+            if cursor_key is not None:
+                if descending:
+                    high = min(high, bisect.bisect_left(keys, cursor_key, low, high))
+                else:
+                    low = max(low, bisect.bisect_right(keys, cursor_key, low, high))
+            indexes = range(high - 1, low - 1, -1) if descending else range(low, high)
+            walks.append(map(keys.__getitem__, indexes))
+
+        page = []
+        for _, emergency_id in heapq.merge(*walks, reverse=descending):
+            em = self.get(emergency_id)
+            if matches(em):
+                page.append(em)
+                if len(page) == count:
+                    break
+        return page
+
+    def _sort_candidates(self, candidates, sort, cursor_key, count) -> List[Any]:
+        """Sort the filtered emergencies, good when few of them match"""
+        descending = sort.startswith("-")
+        keyed = sorted(
+            ((_sort_key(em, sort), em) for em in candidates),
+            key=lambda item: item[0],
+            reverse=descending,
+        )
+        if cursor_key is not None:
+            keyed = [
+                item
+                for item in keyed
+                if (item[0] < cursor_key if descending else item[0] > cursor_key)
+            ]
+        return [em for _, em in keyed[:count]]
+
+
+class EmergencyStore:
+    """In-memory emergencies with an id index and secondary indexes.
+
+    Status, type, severity and intervention id map to the set of emergency
+    ids that have them, and a list sorted by (timestamp, id) serves time
+    ranges and time-ordered pages. Lookups by id and by intervention touch
+    only the matching emergencies, whatever the size of the store.
+
+    Open emergencies are also kept in a grid of DEDUP_RADIUS cells per drone
+    and intervention, so a new report finds the incident it belongs to by
+    looking at the nine cells around it instead of the whole history.
+
+    Writers are serialized by a lock and change the indexes, readers never
+    take the lock: they read the current Snapshot, which every write
+    replaces. Stored emergencies are never modified, a change stores an
+    updated copy. A write copies only the emergencies changed since the
+    last base. Once OVERLAY_LIMIT of them piled up they are folded into a
+    new base, which copies the pages of PAGE_SIZE ids they are in and
+    shares the rest, so the cost of a write does not grow with the store.
+    """
+
+    def __init__(self, journal=None, events=None, cell_size: float = DEDUP_RADIUS):
+        # Gets every added or changed emergency, see persistence.EmergencyJournal
+        self.journal = journal
+        # Publishes every change to live clients, see events.EventLog
+        self.events = events
+        self._lock = threading.RLock()
+        self._by_id: Dict[int, Any] = {}
+        # The same emergencies by page, and the pages changed since the snapshot base
+        self._id_pages: List[Dict[int, Any]] = []
+        self._dirty_pages: Set[int] = set()
+        # Secondary indexes map a key to the ids with it, by page
+        self._by_status: Dict[str, Dict[int, Set[int]]] = {}
+        self._by_type: Dict[str, Dict[int, Set[int]]] = {}
+        self._by_severity: Dict[int, Dict[int, Set[int]]] = {}
+        self._by_intervention: Dict[int, Dict[int, Set[int]]] = {}
+        # The secondary indexes by the _Indexes field they are frozen into,
+        # and the (key, page) of their buckets changed since the snapshot base
+        self._secondary = {
+            "by_status": self._by_status,
+            "by_type": self._by_type,
+            "by_severity": self._by_severity,
+            "by_intervention": self._by_intervention,
+        }
+        self._dirty: Dict[str, Set[Tuple[Any, int]]] = {name: set() for name in self._secondary}
+        # (timestamp, id) of every emergency, sorted
+        self._by_time: List[Tuple[datetime.datetime, int]] = []
+        # Drone, intervention and grid cell to the ids of the open
+        # emergencies in it, and the time of their last report
+        self.cell_size = cell_size
+        self._grid: Dict[Tuple[str, int, int, int], Set[int]] = {}
+        self._last_report: Dict[int, datetime.datetime] = {}
+        self._next_id = 1
+        self.compactions = 0
+        self._snapshot = Snapshot(0, self._freeze(), {}, [])
+
+    def __len__(self) -> int:
+        return len(self._snapshot)
+
+    @property
+    def version(self) -> int:
+        """Number that grows with every change of the store"""
+        return self._snapshot.version
+
+    def snapshot(self) -> Snapshot:
+        """Consistent view of the store, unaffected by later changes"""
+        return self._snapshot
+
+    def _freeze(self, base: _Indexes | None = None, added: bool = True) -> _Indexes:
+        """Copy the indexes into a snapshot base, sharing the pages unchanged since base
+
+        Args:
+            base: Base the changes since are folded into, None copies everything
+            added: Whether emergencies were added since base
+        """
+        if base is None:
+            self._dirty_pages = set(range(len(self._id_pages)))
+            for name, index in self._secondary.items():
+                self._dirty[name] = {(key, page) for key, pages in index.items() for page in pages}
+
+        id_pages = list(base.by_id.pages) if base is not None else []
+        id_pages.extend({} for _ in range(len(self._id_pages) - len(id_pages)))
+        for page in self._dirty_pages:
+            id_pages[page] = dict(self._id_pages[page])
+        self._dirty_pages = set()
+
+        buckets = {}
+        for name, index in self._secondary.items():
+            frozen = dict(getattr(base, name)) if base is not None else {}
+            changed: Dict[Any, _Bucket] = {}
+            for key, page in self._dirty[name]:
+                bucket = changed.get(key)
+                if bucket is None:
+                    bucket = frozen.get(key, _EMPTY)
+                    bucket = changed[key] = _Bucket(dict(bucket.pages), bucket.size)
+                bucket.size -= len(bucket.pages.pop(page, _EMPTY_PAGE))
+                ids = index[key].get(page)
+                if ids:
+                    bucket.pages[page] = frozenset(ids)
+                    bucket.size += len(ids)
+            frozen.update(changed)
+            buckets[name] = frozen
+            self._dirty[name] = set()
+
+        by_time = tuple(self._by_time) if added or base is None else base.by_time
+        return _Indexes(by_id=_IdPages(tuple(id_pages), len(self._by_id)), by_time=by_time, **buckets)
+
+    def _store(self, emergency: Any) -> None:
+        """Put an emergency or its new version into the id index"""
+        self._by_id[emergency.id] = emergency
+        page = emergency.id // PAGE_SIZE
+        if page >= len(self._id_pages):
+            self._id_pages.extend({} for _ in range(page + 1 - len(self._id_pages)))
+        self._id_pages[page][emergency.id] = emergency
+        self._dirty_pages.add(page)
+
+    def _file(self, index: str, key: Any, emergency_id: int, remove: bool = False) -> None:
+        """Add an emergency to or remove it from a bucket of a secondary index"""
+        page = emergency_id // PAGE_SIZE
+        ids = self._secondary[index].setdefault(key, {}).setdefault(page, set())
+        if remove:
+            ids.discard(emergency_id)
+        else:
+            ids.add(emergency_id)
+        self._dirty[index].add((key, page))
+
+    def _publish(self, emergency: Any) -> None:
+        """Replace the snapshot with one that has the new version of an emergency"""
+        snapshot = self._snapshot
+        if len(snapshot._changed) >= OVERLAY_LIMIT:
+            self.compactions += 1
+            added = bool(snapshot._added_times) or emergency.id not in snapshot._base.by_id
+            base = self._freeze(snapshot._base, added)
+            self._snapshot = Snapshot(snapshot.version + 1, base, {}, [])
+            return
+
+        changed = dict(snapshot._changed)
+        added_times = snapshot._added_times
+        if emergency.id not in changed and emergency.id not in snapshot._base.by_id:
+            added_times = list(added_times)
+            bisect.insort(added_times, (emergency.timestamp, emergency.id))
+        changed[emergency.id] = emergency
+        self._snapshot = Snapshot(snapshot.version + 1, snapshot._base, changed, added_times)
+
+    def next_id(self) -> int:
+        """Reserve a new emergency id"""
+        with self._lock:
+            emergency_id = self._next_id
+            self._next_id += 1
+            return emergency_id
+
+    def add(self, emergency: Any) -> Any:
+        with self._lock:
+            self._index(emergency)
+            self._publish(emergency)
+            self._changed(CREATED, emergency)
+            return emergency
+
+    def restore(self, emergencies: Iterable[Any]) -> None:
+        """Add emergencies recovered from the journal, without writing them again"""
+        with self._lock:
+            for emergency in emergencies:
+                self._index(emergency)
+            self._snapshot = Snapshot(self._snapshot.version + 1, self._freeze(), {}, [])
+
+    def _index(self, emergency: Any) -> None:
+        if emergency.id in self._by_id:
+            raise ValueError(f"Emergency {emergency.id} already exists")
+        # Everything that compares timestamps runs before the indexes are
+        # changed, a timestamp that does not compare leaves them untouched
+        key = (emergency.timestamp, emergency.id)
+        if not self._by_time or self._by_time[-1] < key:
+            position = len(self._by_time)
+        else:
+            position = bisect.bisect(self._by_time, key)
+        last_report = None
+        if emergency.status != "RESOLVED":
+            reports = [time for time, status in emergency.changelog if status == REPORTED]
+            last_report = max(reports, default=emergency.timestamp)
+            cell = self._cell(emergency)
+
+        self._next_id = max(self._next_id, emergency.id + 1)
+        self._store(emergency)
+        self._file("by_status", emergency.status, emergency.id)
+        self._file("by_type", emergency.emergency_type, emergency.id)
+        self._file("by_severity", emergency.severity, emergency.id)
+        self._file("by_intervention", emergency.intervention_id, emergency.id)
+        self._by_time.insert(position, key)
+        if last_report is not None:
+            self._last_report[emergency.id] = last_report
+            self._grid.setdefault(cell, set()).add(emergency.id)
+
+    def _cell(self, emergency: Any, dx: int = 0, dy: int = 0) -> Tuple[str, int, int, int]:
+        """Grid cell of an emergency, or the one dx, dy cells away"""
+        return (
+            emergency.drone_id,
+            emergency.intervention_id,
+            math.floor(emergency.location.x / self.cell_size) + dx,
+            math.floor(emergency.location.y / self.cell_size) + dy,
+        )
+
+    def get(self, emergency_id: int) -> Any | None:
+        return self._snapshot.get(emergency_id)
+
+    def by_intervention(self, intervention_id: int) -> List[Any]:
+        return self._snapshot.by_intervention(intervention_id)
+
+    def query(self, *args, **kwargs) -> Tuple[List[Any], str | None]:
+        """Filtered, sorted page of the current snapshot, see Snapshot.query"""
+        return self._snapshot.query(*args, **kwargs)
+
+    def _replace(self, emergency: Any, **changes) -> Any:
+        """Store an updated copy of an emergency, readers keep the one they got"""
+        updated = emergency.model_copy(update=changes)
+        self._store(updated)
+        self._publish(updated)
+        return updated
+
+    def set_status(
+        self, emergency_id: int, status: str, now: datetime.datetime | None = None
+    ) -> Any:
+        """Change the status of an emergency and log the change
+
+        Raises:
+            KeyError: If there is no emergency with the id
+        """
+        with self._lock:
+            emergency = self._by_id[emergency_id]
+            if emergency.status == status:
+                return emergency
+            now = now or datetime.datetime.now()
+            self._file("by_status", emergency.status, emergency_id, remove=True)
+            self._file("by_status", status, emergency_id)
+            cell = self._cell(emergency)
+            if status == "RESOLVED":
+                self._grid.get(cell, set()).discard(emergency_id)
+            else:
+                # Reopened incidents take reports again
+                self._grid.setdefault(cell, set()).add(emergency_id)
+                self._last_report[emergency_id] = now
+            emergency = self._replace(
+                emergency, status=status, changelog=emergency.changelog + [(now, status)]
+            )
+            self._changed(RESOLVED if status == "RESOLVED" else UPDATED, emergency)
+            return emergency
+
+    def report(
+        self, emergency: Any, radius: float = DEDUP_RADIUS, window: float = DEDUP_WINDOW
+    ) -> Tuple[Any, bool]:
+        """Add a reported emergency, or merge it into the open incident it is about
+
+        An open emergency is the same incident when it was reported by the same
+        drone during the same intervention, it is at most radius away, its
+        type is compatible and it was last reported at most window seconds
+        before this report. The closest one takes the report: its severity
+        becomes the higher of both, a specific type replaces "other" and the
+        report is logged in its changelog.
+
+        Args:
+            emergency: The reported emergency, with a new id
+            radius: Largest distance to a matching incident
+            window: Seconds after its last report an incident matches
+
+        Returns:
+            Tuple[Any, bool]: The stored emergency and whether the report was merged
+        """
+        with self._lock:
+            incident = self._find_incident(emergency, radius, window)
+            if incident is None:
+                return self.add(emergency), False
+            return self._merge(incident, emergency), True
+
+    def _find_incident(self, report: Any, radius: float, window: float) -> Any | None:
+        oldest = report.timestamp - datetime.timedelta(seconds=window)
+        reach = math.ceil(radius / self.cell_size)
+        best, best_distance = None, radius
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                cell = self._grid.get(self._cell(report, dx, dy))
+                if not cell:
+                    continue
+                for emergency_id in list(cell):
+                    if self._last_report[emergency_id] < oldest:
+                        # Quiet for too long, it only takes reports again if reopened
+                        cell.discard(emergency_id)
+                        continue
+                    em = self._by_id[emergency_id]
+                    if not _compatible(em.emergency_type, report.emergency_type):
+                        continue
+                    distance = math.hypot(
+                        em.location.x - report.location.x, em.location.y - report.location.y
+                    )
+                    if distance <= best_distance:
+                        best, best_distance = em, distance
+        return best
+
+    def _merge(self, incident: Any, report: Any) -> Any:
+        changes = {
+            "reports": incident.reports + 1,
+            "changelog": incident.changelog + [(report.timestamp, REPORTED)],
+            "image_ref": incident.image_ref or report.image_ref,
+        }
+        if incident.emergency_type == "other" and report.emergency_type != "other":
+            self._file("by_type", incident.emergency_type, incident.id, remove=True)
+            self._file("by_type", report.emergency_type, incident.id)
+            changes["emergency_type"] = report.emergency_type
+        if report.severity > incident.severity:
+            self._file("by_severity", incident.severity, incident.id, remove=True)
+            self._file("by_severity", report.severity, incident.id)
+            changes["severity"] = report.severity
+        self._last_report[incident.id] = max(self._last_report[incident.id], report.timestamp)
+        incident = self._replace(incident, **changes)
+        self._changed(UPDATED, incident)
+        return incident
+
+    def _changed(self, event_type: str, emergency: Any) -> None:
+        if self.journal is not None:
+            self.journal.save(emergency)
+        if self.events is not None:
+            self.events.publish(event_type, emergency)
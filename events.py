@@ -0,0 +1,154 @@
+import asyncio
+import itertools
+import threading
+import uuid
+import weakref
+from collections import deque
+from typing import Any, AsyncIterator, List, NamedTuple
+
+# Events kept for clients that resume or ask for changes
+EVENT_BUFFER = 10_000
+
+# Seconds between SSE comments that keep idle connections open
+KEEPALIVE_INTERVAL = 15.0
+
+CREATED = "created"
+UPDATED = "updated"
+RESOLVED = "resolved"
+
+
+class Event(NamedTuple):
+    seq: int
+    type: str
+    change: bytes  # JSON of the change, {"seq": event id, "type", "emergency"}
+    frame: bytes  # The same change as a Server-Sent Events message
+
+
+class EventGap(Exception):
+    """The requested events are older than the buffer, the client has to reload"""
+
+
+class EventLog:
+    """Numbered changes of the emergency store, fanned out to live subscribers.
+
+    Every change is serialized once when it is published, subscribers and
+    change requests only copy the bytes. Subscribers on an event loop share
+    one wake-up per published event instead of one queue per client.
+    Publishing is thread-safe, the agents publish from their own threads.
+
+    Sequence numbers start over with every log, clients see them as event
+    ids prefixed with the epoch of the log, so an id of an earlier run of
+    the server is not mistaken for one of this run.
+    """
+
+    def __init__(self, maxlen: int = EVENT_BUFFER, epoch: str | None = None):
+        self.epoch = epoch or uuid.uuid4().hex[:8]
+        self._events: deque[Event] = deque(maxlen=maxlen)
+        self._seq = 0
+        self._lock = threading.Lock()
+        # Event set on the next publish, per loop with subscribers
+        self._wakeups: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Event]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    @property
+    def seq(self) -> int:
+        """Sequence number of the last published event, 0 before the first"""
+        return self._seq
+
+    def event_id(self, seq: int) -> str:
+        """Id of the event seq as clients see it, <epoch>-<seq>"""
+        return f"{self.epoch}-{seq}"
+
+    def parse_id(self, event_id: str) -> int:
+        """Sequence number of an event id returned by event_id
+
+        "0" stands for the start of the log, whatever the epoch.
+
+        Raises:
+            EventGap: If the id is from another epoch, e.g. before a restart
+            ValueError: If it is not an event id
+        """
+        if event_id == "0":
+            return 0
+        epoch, _, seq = event_id.rpartition("-")
+        if not epoch or not seq.isdigit():
+            raise ValueError(f"Invalid event id: {event_id!r}")
+        if epoch != self.epoch:
+            raise EventGap(f"Event {event_id} is from an earlier run of the server")
+        return int(seq)
+
+    def publish(self, event_type: str, emergency: Any) -> Event:
+        """Record a change of an emergency and wake the subscribers"""
+        payload = emergency.model_dump_json()
+        with self._lock:
+            self._seq += 1
+            event_id = self.event_id(self._seq)
+            change = f'{{"seq":"{event_id}","type":"{event_type}","emergency":{payload}}}'
+            event = Event(
+                seq=self._seq,
+                type=event_type,
+                change=change.encode("utf-8"),
+                frame=f"id: {event_id}\nevent: {event_type}\ndata: {change}\n\n".encode("utf-8"),
+            )
+            self._events.append(event)
+            loops = list(self._wakeups)
+
+        for loop in loops:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._wake, loop)
+        return event
+
+    def _wake(self, loop: asyncio.AbstractEventLoop) -> None:
+        with self._lock:
+            wakeup = self._wakeups.pop(loop, None)
+        if wakeup is not None:
+            wakeup.set()
+
+    def _wakeup(self) -> asyncio.Event:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            wakeup = self._wakeups.get(loop)
+            if wakeup is None:
+                wakeup = self._wakeups[loop] = asyncio.Event()
+            return wakeup
+
+    def since(self, seq: int) -> List[Event]:
+        """Events published after seq
+
+        Raises:
+            EventGap: If some of them were dropped from the buffer already,
+                or seq is ahead of the log
+        """
+        with self._lock:
+            if seq > self._seq:
+                # Numbered by an earlier run of the server
+                raise EventGap(f"Event {seq} was never published")
+            if seq == self._seq:
+                return []
+            first = self._events[0].seq if self._events else self._seq + 1
+            if seq < first - 1:
+                raise EventGap(f"Events after {seq} are no longer available")
+            # Walk from the newest end, resuming clients are usually close to it
+            return list(itertools.islice(reversed(self._events), self._seq - seq))[::-1]
+
+    async def subscribe(self, since: int) -> AsyncIterator[List[Event]]:
+        """Yield batches of events published after since, waiting for new ones
+
+        Yields an empty batch every KEEPALIVE_INTERVAL seconds without events.
+
+        Raises:
+            EventGap: If the subscriber fell behind the buffer
+        """
+        while True:
+            # Taken before looking for events, so a publish in between wakes us
+            wakeup = self._wakeup()
+            events = self.since(since)
+            if events:
+                since = events[-1].seq
+                yield events
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield []
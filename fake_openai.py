@@ -0,0 +1,177 @@
+"""Local stand-in for the OpenAI Responses and speech APIs, for benchmarks and offline runs.
+
+Start it with `uvicorn fake_openai:app --port 8001` and point the drone
+agent at it with OPENAI_BASE_URL=http://127.0.0.1:8001/v1. It enforces
+requests and tokens per minute like the real API and answers over the
+limit with 429, so rate limiting can be checked without an account.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from fleet import TokenBucket
+
+# Limits of the fake account, 0 disables a limit
+FAKE_REQUESTS_PER_MINUTE = int(os.getenv("FAKE_REQUESTS_PER_MINUTE", "0"))
+FAKE_TOKENS_PER_MINUTE = int(os.getenv("FAKE_TOKENS_PER_MINUTE", "0"))
+# Like the real API, limits are enforced over short intervals, not per minute
+FAKE_BURST_SECONDS = float(os.getenv("FAKE_BURST_SECONDS", "10"))
+
+# Simulated model latency in seconds
+FAKE_LATENCY = float(os.getenv("FAKE_LATENCY", "0.2"))
+
+# Same rough token estimate the fleet scheduler uses, images counted separately
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1100
+OUTPUT_TOKENS = 50
+
+# One silent MPEG-1 Layer III frame (128 kbit/s, 44.1 kHz), about 26 ms of audio
+SILENT_MP3_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+
+# Structured outputs returned for the text formats the agent asks for
+STRUCTURED_OUTPUTS = {
+    "SceneAnalysis": {
+        "detections": [
+            {
+                "label": "overturned car",
+                "category": "car_crash",
+                "confidence": 0.9,
+                "x": 0.4,
+                "y": 0.6,
+                "bbox": {"x_min": 0.3, "y_min": 0.5, "x_max": 0.5, "y_max": 0.7},
+                "text": "",
+            }
+        ]
+    },
+    "SecurityCheckResponse": {"is_safe": True, "reason": ""},
+}
+
+app = FastAPI()
+
+_ids = itertools.count()
+_lock = threading.Lock()
+_buckets: dict[str, TokenBucket] = {}
+_stats = {"requests": 0, "rate_limited": 0, "tokens": 0}
+
+
+def configure(requests_per_minute: int, tokens_per_minute: int) -> None:
+    """Set the limits of the fake account, 0 disables a limit"""
+    with _lock:
+        _buckets.clear()
+        for name, per_minute in (("requests", requests_per_minute), ("tokens", tokens_per_minute)):
+            if per_minute:
+                _buckets[name] = TokenBucket(per_minute, per_minute * FAKE_BURST_SECONDS / 60)
+
+
+def _input_tokens(body: dict) -> int:
+    text = json.dumps(body.get("input", ""))
+    images = text.count("data:image/")
+    # Drop the base64 payloads, they are billed per image
+    chars = sum(len(part) for part in text.split('"data:image/')[::2])
+    chars += len(body.get("instructions") or "")
+    return chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS
+
+
+def _admit(tokens: int) -> bool:
+    """Take a request from the account limits, False if it is over a limit"""
+    now = time.monotonic()
+    cost = {"requests": 1, "tokens": tokens}
+    with _lock:
+        if any(bucket.wait_time(cost[name], now) > 0 for name, bucket in _buckets.items()):
+            _stats["rate_limited"] += 1
+            return False
+        for name, bucket in _buckets.items():
+            bucket.consume(cost[name])
+        _stats["requests"] += 1
+        _stats["tokens"] += tokens
+        return True
+
+
+def _rate_limited() -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={
+            "error": {
+                "message": "Rate limit reached",
+                "type": "requests",
+                "code": "rate_limit_exceeded",
+            }
+        },
+        headers={"retry-after-ms": "1000"},
+    )
+
+
+def _response(body: dict, text: str, input_tokens: int) -> dict:
+    return {
+        "id": f"resp_{next(_ids)}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": body.get("model", "gpt-4.1-nano"),
+        "output": [
+            {
+                "type": "message",
+                "id": f"msg_{next(_ids)}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }
+        ],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "status": "completed",
+        "usage": {
+            "input_tokens": input_tokens,
+            "output_tokens": OUTPUT_TOKENS,
+            "total_tokens": input_tokens + OUTPUT_TOKENS,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens_details": {"reasoning_tokens": 0},
+        },
+    }
+
+
+@app.post("/v1/responses")
+async def responses(request: Request):
+    body = await request.json()
+    input_tokens = _input_tokens(body)
+    if not _admit(input_tokens + OUTPUT_TOKENS):
+        return _rate_limited()
+
+    await asyncio.sleep(FAKE_LATENCY)
+    text_format = (body.get("text") or {}).get("format") or {}
+    if text_format.get("type") == "json_schema":
+        text = json.dumps(STRUCTURED_OUTPUTS.get(text_format.get("name"), {}))
+    else:
+        text = "Nothing that needs attention, continuing patrol."
+    return _response(body, text, input_tokens)
+
+
+@app.post("/v1/audio/speech")
+async def speech(request: Request):
+    """Text-to-speech stand-in, silence roughly as long as the text would take to say"""
+    body = await request.json()
+    text = body.get("input", "")
+    if not _admit(len(text) // CHARS_PER_TOKEN):
+        return _rate_limited()
+
+    await asyncio.sleep(FAKE_LATENCY)
+    # About 15 characters per second of speech
+    frames = max(1, round(len(text) / 15 / 0.026))
+    return Response(content=SILENT_MP3_FRAME * frames, media_type="audio/mpeg")
+
+
+@app.get("/stats")
+async def stats():
+    """Accepted and rate limited requests since start"""
+    with _lock:
+        return dict(_stats)
+
+
+configure(FAKE_REQUESTS_PER_MINUTE, FAKE_TOKENS_PER_MINUTE)
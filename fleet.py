@@ -0,0 +1,248 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict
+
+from metrics import FLEET_GRANTS, FLEET_WAIT_SECONDS
+
+# Account limits shared by all drones in the process
+FLEET_REQUESTS_PER_MINUTE = int(os.getenv("FLEET_REQUESTS_PER_MINUTE", "500"))
+FLEET_TOKENS_PER_MINUTE = int(os.getenv("FLEET_TOKENS_PER_MINUTE", "200000"))
+# The API enforces its limits over short intervals, so only this many
+# seconds worth of the per-minute budget may be sent in one burst
+FLEET_BURST_SECONDS = float(os.getenv("FLEET_BURST_SECONDS", "10"))
+
+# Lower value is served first, states not listed get the lowest priority
+PRIORITIES = {
+    "EMERGENCY_HANDLING": 0,
+    "INVESTIGATION": 1,
+    "NON_EMERGENCY_HANDLING": 1,
+    "PATROL": 2,
+}
+LOWEST_PRIORITY = max(PRIORITIES.values())
+
+# Rough token cost of a request, used until the response reports the real usage
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1100
+OUTPUT_TOKENS = 300
+
+
+def estimate_tokens(*texts: str, images: int = 0) -> int:
+    """Estimate the tokens a request will use before sending it
+
+    Args:
+        texts: Text sent with the request
+        images: Number of images sent with the request
+
+    Returns:
+        int: Estimated input plus output tokens
+    """
+    chars = sum(len(text) for text in texts)
+    return chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS + OUTPUT_TOKENS
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at a per-minute rate, not thread-safe"""
+
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount can be consumed, 0 if it can be right now"""
+        self._refill(now)
+        # A request larger than the bucket goes through once the bucket is full
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing, 0.0) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        """Give back tokens, negative amounts charge usage above the estimate"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class _Waiter:
+    def __init__(self, drone_id: str, state: str, tokens: int):
+        self.drone_id = drone_id
+        self.state = state
+        self.tokens = tokens
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.enqueued = time.perf_counter()
+        self.granted = False
+
+
+class FleetGrant:
+    """Permission to send one request, settled with the usage it really had"""
+
+    def __init__(self, scheduler: "FleetScheduler", tokens: int):
+        self.scheduler = scheduler
+        self.tokens = tokens
+
+    def settle(self, used_tokens: int) -> None:
+        """Correct the token bucket by the difference to the estimate"""
+        self.scheduler._refund(self.tokens - used_tokens)
+        self.tokens = used_tokens
+
+
+class FleetScheduler:
+    """Rate limiter shared by all DroneAgents of a process.
+
+    Requests wait for a global requests-per-minute and tokens-per-minute
+    budget. Waiting requests are served by the priority of the state of the
+    drone that sent them, and round-robin between drones of the same
+    priority, so one busy drone cannot starve the others. Thread-safe, every
+    DroneAgent may run on its own event loop.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = FLEET_REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = FLEET_TOKENS_PER_MINUTE,
+    ):
+        burst = FLEET_BURST_SECONDS / 60
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute * burst)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute * burst)
+        self._lock = threading.Lock()
+        # priority -> drone id -> waiters, the drone served next comes first
+        self._queues: Dict[int, OrderedDict[str, deque]] = {
+            priority: OrderedDict() for priority in sorted(set(PRIORITIES.values()))
+        }
+        self._timer: threading.Timer | None = None
+        self._timer_deadline = 0.0
+        # state -> [grants, total seconds waited, longest wait]
+        self._stats: Dict[str, list] = {}
+
+    async def acquire(self, drone_id: str, state: str, tokens: int) -> FleetGrant:
+        """Wait until the fleet budget allows another request
+
+        Args:
+            drone_id: Drone sending the request
+            state: State of the drone, sets the priority of the request
+            tokens: Estimated tokens of the request, see estimate_tokens
+
+        Returns:
+            FleetGrant: Settle it with the real token usage of the response
+        """
+        waiter = _Waiter(drone_id, state, tokens)
+        priority = PRIORITIES.get(state, LOWEST_PRIORITY)
+        with self._lock:
+            self._queues[priority].setdefault(drone_id, deque()).append(waiter)
+            self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    # Granted but never sent, the budget can go to someone else
+                    self.requests.refund(1)
+                    self.tokens.refund(tokens)
+                else:
+                    self._remove(priority, waiter)
+                self._dispatch()
+            raise
+
+        waited = time.perf_counter() - waiter.enqueued
+        FLEET_GRANTS.inc(state=state)
+        FLEET_WAIT_SECONDS.observe(waited, state=state)
+        with self._lock:
+            stats = self._stats.setdefault(state, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+        return FleetGrant(self, tokens)
+
+    def _remove(self, priority: int, waiter: _Waiter) -> None:
+        drones = self._queues[priority]
+        waiters = drones.get(waiter.drone_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del drones[waiter.drone_id]
+
+    def _refund(self, tokens: int) -> None:
+        with self._lock:
+            self.tokens.refund(tokens)
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Grant waiting requests while the budget allows, called with the lock held"""
+        while True:
+            drones = next((d for d in self._queues.values() if d), None)
+            if drones is None:
+                return
+
+            drone_id, waiters = next(iter(drones.items()))
+            waiter = waiters[0]
+            now = time.monotonic()
+            wait = max(
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(waiter.tokens, now),
+            )
+            if wait > 0:
+                # Lower priorities keep waiting behind the head of the queue
+                self._schedule(now + wait)
+                return
+
+            self.requests.consume(1)
+            self.tokens.consume(waiter.tokens)
+            waiters.popleft()
+            if waiters:
+                drones.move_to_end(drone_id)
+            else:
+                del drones[drone_id]
+            waiter.granted = True
+            waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+
+    def _schedule(self, deadline: float) -> None:
+        """Run _dispatch again at deadline, when the buckets have refilled"""
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = threading.Timer(deadline - time.monotonic(), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def queued(self) -> Dict[str, int]:
+        """Number of waiting requests per drone"""
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for drones in self._queues.values():
+                for drone_id, waiters in drones.items():
+                    counts[drone_id] = counts.get(drone_id, 0) + len(waiters)
+            return counts
+
+    def stats(self) -> Dict[str, dict]:
+        """Grants and waiting times per state"""
+        with self._lock:
+            return {
+                state: {
+                    "grants": grants,
+                    "mean_wait_ms": total / grants * 1000,
+                    "max_wait_ms": longest * 1000,
+                }
+                for state, (grants, total, longest) in self._stats.items()
+            }
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,107 @@
+import re
+from typing import List, Literal, NamedTuple
+
+BENIGN = "benign"
+MALICIOUS = "malicious"
+AMBIGUOUS = "ambiguous"
+
+# Patterns that only show up in prompt injection attempts, any match is malicious
+STRONG_PATTERNS = [
+    r"system:",
+    r"assistant:",
+    r"user:",
+    r"ignore previous",
+    r"ignore above",
+    r"new instructions",
+    r"prompt override",
+    r"<\w+>",  # XML-like tags
+    r"function\s*\(",  # Function calls
+    r"eval\s*\(",
+    r"exec\s*\(",
+    r"import\s+\w+",
+    r"require\s+['\"].*?['\"]",
+]
+
+# Weaker signals of text or commands in the scene, weighted. Words are looked
+# up one by one in the lowercased description, the patterns are regexes.
+WEAK_WORDS = {
+    **dict.fromkeys(
+        ["land", "abort", "override", "instruction", "instructions", "command",
+         "disregard", "forget", "pretend", "obey"],
+        3,
+    ),
+    "immediately": 2,
+    **dict.fromkeys(
+        ["text", "sign", "banner", "written", "writing", "reads", "says", "message",
+         "letters", "note"],
+        1,
+    ),
+}
+WEAK_PATTERNS = [
+    (r"\b(?:right now|you must|do not report)\b", 2),
+    (r"[\"“'](?=[^\"”']{3,}[\"”'])", 1),  # opening quote of quoted text
+]
+# Shouted words, matched on the original case
+SHOUTED_PATTERN = (r"\b[A-Z]{3,}\b(?=\s+[A-Z]{3,}\b)", 1)
+
+# Score at or above which the description is treated as malicious without an LLM
+MALICIOUS_SCORE = 6
+
+# Descriptions longer than this are treated as malicious
+MAX_LENGTH = 10000
+
+# Strong patterns compiled into a single alternation, matched in one pass over
+# the lowercased description. Case-insensitive alternations are several times
+# slower than lowercasing first.
+STRONG_RE = re.compile("|".join(STRONG_PATTERNS))
+
+WORD_RE = re.compile(r"[a-z]+")
+WEAK_RE = re.compile(
+    "|".join(f"(?P<w{i}>{pattern})" for i, (pattern, _) in enumerate(WEAK_PATTERNS))
+)
+SHOUTED_RE = re.compile(SHOUTED_PATTERN[0])
+
+
+class ScreenResult(NamedTuple):
+    verdict: Literal["benign", "malicious", "ambiguous"]
+    score: int
+    matches: List[str]
+
+
+def screen_description(image_description: str) -> ScreenResult:
+    """Cheap local prompt injection screen of an image description
+
+    Args:
+        image_description: Description of the image
+
+    Returns:
+        ScreenResult: "malicious" and "benign" are final, "ambiguous" needs
+            an LLM check
+    """
+    if len(image_description.strip()) > MAX_LENGTH:
+        return ScreenResult(MALICIOUS, MALICIOUS_SCORE, ["<too long>"])
+
+    text = image_description.lower()
+    match = STRONG_RE.search(text)
+    if match is not None:
+        return ScreenResult(MALICIOUS, MALICIOUS_SCORE, [match.group()])
+
+    score = 0
+    matches = []
+    for word in WORD_RE.findall(text):
+        weight = WEAK_WORDS.get(word)
+        if weight is not None:
+            score += weight
+            matches.append(word)
+    for match in WEAK_RE.finditer(text):
+        score += WEAK_PATTERNS[int(match.lastgroup[1:])][1]
+        matches.append(match.group())
+    for match in SHOUTED_RE.finditer(image_description):
+        score += SHOUTED_PATTERN[1]
+        matches.append(match.group())
+
+    if score == 0:
+        return ScreenResult(BENIGN, score, matches)
+    if score >= MALICIOUS_SCORE:
+        return ScreenResult(MALICIOUS, score, matches)
+    return ScreenResult(AMBIGUOUS, score, matches)
@@ -0,0 +1,135 @@
+import asyncio
+import contextvars
+import os
+import weakref
+from contextlib import asynccontextmanager
+from typing import NamedTuple
+
+from agents import OpenAIProvider
+from openai import DEFAULT_CONNECTION_LIMITS, AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
+
+from fleet import OUTPUT_TOKENS, FleetGrant, FleetScheduler
+
+# Connection pool shared by the vision call, the guardrails and the agents
+MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+
+# Upper bound on requests we issue ourselves at the same time
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENT_REQUESTS", "8"))
+
+# Per-call timeouts in seconds
+CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+DEFAULT_TIMEOUT = float(os.getenv("OPENAI_DEFAULT_TIMEOUT", "60"))
+VISION_TIMEOUT = float(os.getenv("OPENAI_VISION_TIMEOUT", "30"))
+GUARDRAIL_TIMEOUT = float(os.getenv("OPENAI_GUARDRAIL_TIMEOUT", "10"))
+
+# Limits class of the httpx package the installed openai client is built on
+_Limits = type(DEFAULT_CONNECTION_LIMITS)
+
+
+class _Pool:
+    # No reference to the loop, it is the key of the pool in _pools
+    def __init__(self):
+        self.client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(
+                limits=_Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+                timeout=Timeout(DEFAULT_TIMEOUT, connect=CONNECT_TIMEOUT),
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # Lets the agents SDK reuse the same connections for Runner.run
+        self.model_provider = OpenAIProvider(openai_client=self.client)
+        self._closer = self._close_on_shutdown()
+
+    def bind(self) -> None:
+        """Close the client when the running loop shuts down its async generators.
+
+        asyncio.run() and DroneAgent.close() call loop.shutdown_asyncgens()
+        before closing the loop, which finalizes the generator started here.
+        """
+        step = self._closer.__anext__()
+        try:
+            # Runs to the first yield without awaiting anything
+            step.send(None)
+        except StopIteration:
+            pass
+
+    async def _close_on_shutdown(self):
+        try:
+            yield
+        finally:
+            # The generator holds the finalizer of the loop, drop it with the client
+            self._closer = None
+            await self.client.close()
+
+
+# One pool per event loop, its client is closed when the loop shuts down and
+# the entry is dropped together with the loop
+_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _Pool]" = weakref.WeakKeyDictionary()
+
+
+class FleetSlot(NamedTuple):
+    scheduler: FleetScheduler
+    drone_id: str
+    state: str
+
+
+# Scheduler and drone of the step being processed, None outside of a fleet
+fleet_slot: contextvars.ContextVar[FleetSlot | None] = contextvars.ContextVar(
+    "fleet_slot", default=None
+)
+
+
+def _get_pool() -> _Pool:
+    """Return the pool bound to the running event loop.
+
+    httpx connections cannot outlive the loop they were opened on, so every
+    loop, e.g. one per DroneAgent of a fleet, gets its own pool.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = _Pool()
+        pool.bind()
+    return pool
+
+
+def get_async_client() -> AsyncOpenAI:
+    """Get the shared AsyncOpenAI client for the running event loop"""
+    return _get_pool().client
+
+
+def get_model_provider() -> OpenAIProvider:
+    """Model provider for Runner.run using the shared client of the running loop"""
+    return _get_pool().model_provider
+
+
+async def acquire_fleet_grant(tokens: int) -> FleetGrant | None:
+    """Wait for the fleet scheduler of the current step, if there is one"""
+    slot = fleet_slot.get()
+    if slot is None:
+        return None
+    return await slot.scheduler.acquire(slot.drone_id, slot.state, tokens)
+
+
+@asynccontextmanager
+async def request_slot(tokens: int = OUTPUT_TOKENS):
+    """Limit the OpenAI requests we issue ourselves.
+
+    Waits for the fleet rate limit first, then for one of the concurrent
+    request slots of the loop.
+
+    Args:
+        tokens: Estimated tokens of the request, see fleet.estimate_tokens
+
+    Yields:
+        FleetGrant | None: Grant to settle with the usage of the response
+    """
+    grant = await acquire_fleet_grant(tokens)
+    async with _get_pool().semaphore:
+        yield grant
@@ -0,0 +1,479 @@
+import argparse
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, NamedTuple
+
+import httpx
+
+# The history is written to a temporary database, not the server's default one
+os.environ.setdefault("EMERGENCY_DB", "")
+
+EMERGENCY_TYPES = [
+    "car_crash",
+    "fire",
+    "medical_emergency",
+    "natural_disaster",
+    "suspicious_activity",
+    "other",
+]
+
+# Seconds to wait for the server to answer after it was started
+STARTUP_TIMEOUT = 60.0
+
+OPERATIONS = [
+    "report",
+    "resolve",
+    "list",
+    "list_cards",
+    "list_cached",
+    "list_filtered",
+    "list_next",
+    "get",
+    "changes",
+    "image",
+    "thumbnail",
+]
+# Operations that download the image of a report, they need reports with images
+IMAGE_OPERATIONS = {"image", "thumbnail"}
+# Image size when a mix downloads images but its scenario has none
+DEFAULT_IMAGE_KB = 100
+
+
+class Scenario(NamedTuple):
+    description: str
+    history: int  # Emergencies stored before the test
+    mix: Dict[str, float]  # Operation name to its share of the requests
+    image_kb: int = 0  # Size of the images uploaded with the reports, 0 for none
+
+
+SCENARIOS = {
+    "mixed": Scenario(
+        "Drones reporting and dashboards reading",
+        history=1_000,
+        mix={"report": 0.2, "resolve": 0.05, "list": 0.4, "list_cards": 0.2, "get": 0.15},
+    ),
+    "drones": Scenario(
+        "Mostly reports and resolved interventions",
+        history=1_000,
+        mix={"report": 0.7, "resolve": 0.15, "list": 0.15},
+    ),
+    "dashboards": Scenario(
+        "Mostly list pages, revalidated with their ETag",
+        history=10_000,
+        mix={"list": 0.3, "list_cards": 0.3, "list_cached": 0.3, "changes": 0.1},
+    ),
+    "images": Scenario(
+        "Reports with large images, image and thumbnail downloads",
+        history=1_000,
+        mix={"report": 0.4, "image": 0.3, "thumbnail": 0.3},
+        image_kb=400,
+    ),
+    "history": Scenario(
+        "Filtered and paginated reads of a large history",
+        history=100_000,
+        mix={"list": 0.3, "list_filtered": 0.3, "list_next": 0.2, "get": 0.1, "report": 0.1},
+    ),
+}
+
+
+def _history_db(path: str, count: int) -> None:
+    """Write count emergencies a minute apart to a database the server recovers from"""
+    from emergency_server import Emergency, Location
+    from persistence import EmergencyJournal
+
+    rng = random.Random(0)
+    start = datetime.datetime.now() - datetime.timedelta(minutes=count)
+    journal = EmergencyJournal(path)
+    for i in range(count):
+        journal.save(
+            Emergency(
+                id=i + 1,
+                intervention_id=i // 10,
+                emergency_type=rng.choice(EMERGENCY_TYPES),
+                location=Location(x=rng.random(), y=rng.random()),
+                status="RESOLVED" if rng.random() < 0.95 else "IN_PROGRESS",
+                severity=rng.randint(1, 5),
+                timestamp=start + datetime.timedelta(minutes=i),
+                description="Emergency detected during the load test",
+                changelog=[],
+            )
+        )
+    journal.close()
+
+
+def _images(count: int, size_kb: int) -> List[bytes]:
+    """JPEG images of random noise, roughly size_kb each"""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    # Noise barely compresses, about 1.5 bytes per pixel at the default quality
+    side = max(int((size_kb * 1024 / 1.5) ** 0.5), 16)
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 256, (side, side, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG")
+        images.append(buffer.getvalue())
+    return images
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Mix given as operation=weight pairs separated by commas"""
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                f"Unknown operation {name!r}, any of {', '.join(OPERATIONS)}"
+            )
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Weight of {name} is not a number: {weight!r}") from None
+        if mix[name] < 0:
+            raise argparse.ArgumentTypeError(f"Weight of {name} is negative")
+    if not sum(mix.values()):
+        raise argparse.ArgumentTypeError("The mix has no operation with a positive weight")
+    return mix
+
+
+class LoadTest:
+    """Requests of one scenario against the emergency API, with their latencies"""
+
+    def __init__(self, client: httpx.AsyncClient, scenario: Scenario, seed: int = 0):
+        self.client = client
+        self.scenario = scenario
+        self.rng = random.Random(seed)
+        self.latencies: Dict[str, List[float]] = {name: [] for name in scenario.mix}
+        self.errors: Dict[str, int] = {name: 0 for name in scenario.mix}
+        # Ids of the reports made, the history has the ids 1 to history
+        self.reported: List[int] = []
+        self.intervention = scenario.history // 10 + 1
+        self.with_images: List[int] = []
+        self.images = _images(16, scenario.image_kb) if scenario.image_kb else []
+        self.cursor: str | None = None
+        self.etag = ""
+        self.seq = "0"
+        self._names = list(scenario.mix)
+        self._weights = list(scenario.mix.values())
+
+    def pick(self) -> str:
+        return self.rng.choices(self._names, self._weights)[0]
+
+    async def run_one(self, name: str, scheduled: float | None = None) -> None:
+        """Send one request, latency counted from scheduled if given"""
+        start = scheduled if scheduled is not None else time.perf_counter()
+        try:
+            response = await getattr(self, f"_{name}")()
+            if response.status_code >= 400:
+                self.errors[name] += 1
+                return
+        except httpx.HTTPError:
+            self.errors[name] += 1
+            return
+        self.latencies[name].append(time.perf_counter() - start)
+
+    async def _report(self) -> httpx.Response:
+        image_ref = ""
+        if self.images:
+            image = self.rng.choice(self.images)
+            image_ref = hashlib.sha256(image).hexdigest()
+            if (await self.client.head(f"/blobs/{image_ref}")).status_code != 200:
+                await self.client.put(f"/blobs/{image_ref}", content=image)
+        self.intervention += self.rng.random() < 0.2
+        report = {
+            "key": f"load-{self.rng.getrandbits(64):016x}",
+            "intervention_id": self.intervention,
+            "emergency_type": self.rng.choice(EMERGENCY_TYPES),
+            "location": {"x": self.rng.random(), "y": self.rng.random()},
+            "severity": self.rng.randint(1, 5),
+            "description": "Emergency detected during the load test",
+            "image_ref": image_ref,
+        }
+        response = await self.client.post("/emergencies:batch", json={"reports": [report]})
+        if response.status_code == 200:
+            emergency_id = response.json()["results"][0]["id"]
+            self.reported.append(emergency_id)
+            if image_ref:
+                self.with_images.append(emergency_id)
+        return response
+
+    async def _resolve(self) -> httpx.Response:
+        intervention = self.rng.randint(max(self.intervention - 50, 0), self.intervention)
+        return await self.client.post("/emergencies:batch", json={"resolved": [intervention]})
+
+    async def _list(self) -> httpx.Response:
+        return await self.client.get("/emergencies", params={"limit": 50})
+
+    async def _list_cards(self) -> httpx.Response:
+        params = {"limit": 100, "fields": "id,emergency_type,status,severity,timestamp"}
+        return await self.client.get("/emergencies", params=params)
+
+    async def _list_cached(self) -> httpx.Response:
+        """Revalidation of the page a dashboard shows, 304 while nothing changed"""
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        response = await self.client.get(
+            "/emergencies", params={"status": "IN_PROGRESS"}, headers=headers
+        )
+        self.etag = response.headers.get("etag", self.etag)
+        return response
+
+    async def _list_filtered(self) -> httpx.Response:
+        params = {
+            "emergency_type": self.rng.choice(EMERGENCY_TYPES),
+            "severity_gte": self.rng.randint(3, 5),
+            "sort": self.rng.choice(["-timestamp", "-severity"]),
+            "limit": 50,
+        }
+        return await self.client.get("/emergencies", params=params)
+
+    async def _list_next(self) -> httpx.Response:
+        """Next page of a dashboard scrolling through the history"""
+        params = {"limit": 50}
+        if self.cursor:
+            params["after"] = self.cursor
+        response = await self.client.get("/emergencies", params=params)
+        self.cursor = response.headers.get("x-next-cursor")
+        return response
+
+    async def _get(self) -> httpx.Response:
+        history = self.scenario.history
+        if self.reported and self.rng.random() * (history + len(self.reported)) >= history:
+            emergency_id = self.rng.choice(self.reported)
+        else:
+            emergency_id = self.rng.randint(1, max(history, 1))
+        return await self.client.get(f"/emergencies/{emergency_id}")
+
+    async def _changes(self) -> httpx.Response:
+        response = await self.client.get("/emergencies/changes", params={"since": self.seq})
+        if response.status_code == 200:
+            self.seq = response.json()["seq"]
+        elif response.status_code == 410:
+            # Fell behind the event buffer, a dashboard would reload
+            self.seq = "0"
+        return response
+
+    async def _image(self) -> httpx.Response:
+        emergency_id = self.rng.choice(self.with_images)
+        return await self.client.get(f"/emergencies/{emergency_id}/image")
+
+    async def _thumbnail(self) -> httpx.Response:
+        emergency_id = self.rng.choice(self.with_images)
+        return await self.client.get(f"/emergencies/{emergency_id}/thumbnail")
+
+    async def prepare(self) -> None:
+        """Report a few emergencies with images, so there are images to download"""
+        for _ in range(len(self.images)):
+            await self._report()
+        if self.images and not self.with_images:
+            raise RuntimeError("No report with an image was accepted, nothing to download")
+
+
+async def _closed_loop(test: LoadTest, concurrency: int, duration: float) -> None:
+    """concurrency clients, each sending its next request when the last one is answered"""
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            await test.run_one(test.pick())
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+async def _open_loop(test: LoadTest, rate: float, duration: float) -> None:
+    """Requests started at a fixed rate whatever the latency, which is counted
+    from the time a request was due, so a slow server cannot hide its queue"""
+    start = time.perf_counter()
+    tasks = set()
+    for k in range(int(rate * duration)):
+        scheduled = start + k / rate
+        await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+        task = asyncio.create_task(test.run_one(test.pick(), scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+
+def _percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _summary(latencies: List[float], errors: int, duration: float) -> dict:
+    summary = {"requests": len(latencies), "errors": errors, "throughput": len(latencies) / duration}
+    if latencies:
+        summary.update(
+            {
+                f"{name}_ms": _percentile(latencies, fraction) * 1e3
+                for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))
+            }
+        )
+    return summary
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def start_server(port: int, directory: str, history: int) -> subprocess.Popen:
+    """Run the emergency API in its own process, with history emergencies stored
+
+    The server gets its own interpreter, so it does not share the GIL with
+    the load generator.
+    """
+    db = os.path.join(directory, "emergencies.db")
+    if history:
+        _history_db(db, history)
+    env = dict(os.environ, EMERGENCY_DB=db, BLOB_DIR=os.path.join(directory, "blobs"))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "emergency_server:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+    deadline = time.perf_counter() + STARTUP_TIMEOUT
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Emergency server exited with code {server.returncode}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1.0)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Emergency server did not start in time")
+
+
+async def run_scenario(url: str, scenario: Scenario, args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30.0) as client:
+        test = LoadTest(client, scenario, seed=args.seed)
+        await test.prepare()
+        start = time.perf_counter()
+        if args.rate:
+            await _open_loop(test, args.rate, args.duration)
+        else:
+            await _closed_loop(test, args.concurrency, args.duration)
+        elapsed = time.perf_counter() - start
+
+    everything = [latency for values in test.latencies.values() for latency in values]
+    return {
+        "description": scenario.description,
+        "history": scenario.history,
+        "image_kb": scenario.image_kb,
+        "mix": scenario.mix,
+        "duration": elapsed,
+        "total": _summary(everything, sum(test.errors.values()), elapsed),
+        "operations": {
+            name: _summary(test.latencies[name], test.errors[name], elapsed) for name in scenario.mix
+        },
+    }
+
+
+def print_results(name: str, result: dict, baseline: dict | None = None) -> None:
+    print(f"\n{name}: {result['description']}, {result['history']} emergencies stored")
+    rows = [("total", result["total"])] + list(result["operations"].items())
+    for operation, summary in rows:
+        line = (
+            f"{operation:>14}: {summary['throughput']:8.1f} req/s, {summary['errors']:4d} errors"
+        )
+        if summary["requests"]:
+            line += (
+                f", p50 {summary['p50_ms']:7.2f} ms, p90 {summary['p90_ms']:7.2f} ms, "
+                f"p99 {summary['p99_ms']:7.2f} ms"
+            )
+        old = (baseline or {}).get("total" if operation == "total" else "operations", {})
+        old = old if operation == "total" else old.get(operation)
+        if old and old.get("requests") and summary["requests"]:
+            line += (
+                f" ({summary['throughput'] / old['throughput'] - 1:+.0%} req/s, "
+                f"p99 {summary['p99_ms'] / old['p99_ms'] - 1:+.0%})"
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the emergency API")
+    parser.add_argument("scenarios", nargs="*", default=["mixed"], help=f"Any of {', '.join(SCENARIOS)}")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="Clients of the closed loop")
+    parser.add_argument("--rate", type=float, default=0.0, help="Requests per second, open loop")
+    parser.add_argument("--history", type=int, help="Emergencies stored before the test")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        help="Share of each operation instead of the scenario's, e.g. report=0.5,list=0.5",
+    )
+    parser.add_argument("--url", help="Test a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - SCENARIOS.keys()
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["scenarios"]
+
+    results = {
+        "commit": _git_commit(),
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "settings": {
+            "duration": args.duration,
+            "concurrency": None if args.rate else args.concurrency,
+            "rate": args.rate or None,
+        },
+        "scenarios": {},
+    }
+    for name in args.scenarios:
+        scenario = SCENARIOS[name]
+        if args.history is not None:
+            scenario = scenario._replace(history=args.history)
+        if args.mix:
+            scenario = scenario._replace(mix=args.mix)
+        if not scenario.image_kb and IMAGE_OPERATIONS & scenario.mix.keys():
+            scenario = scenario._replace(image_kb=DEFAULT_IMAGE_KB)
+        if args.url:
+            result = asyncio.run(run_scenario(args.url, scenario, args))
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                print(f"Starting the server with {scenario.history} emergencies for {name}...")
+                server = start_server(args.port, directory, scenario.history)
+                try:
+                    result = asyncio.run(run_scenario(f"http://127.0.0.1:{args.port}", scenario, args))
+                finally:
+                    server.terminate()
+                    server.wait()
+        results["scenarios"][name] = result
+        print_results(name, result, baseline.get(name))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
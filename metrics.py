@@ -0,0 +1,167 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# Upper bounds of the latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: List[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with labels, rendered in Prometheus text format"""
+
+    def __init__(self, name: str, documentation: str, labelnames: List[str]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative histogram with labels, rendered in Prometheus text format"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: List[str],
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> (count per bucket, sum, count)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All registered metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STEP_SECONDS = REGISTRY.register(
+    Histogram("drone_step_seconds", "Duration of a full DroneAgent step", ["state"])
+)
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "drone_stage_seconds",
+        "Duration of DroneAgent step stages (encode, analyze_image, guardrail, add_emergency)",
+        ["stage", "state"],
+    )
+)
+RUNNER_SECONDS = REGISTRY.register(
+    Histogram("drone_runner_seconds", "Duration of Runner.run per starting agent", ["agent", "state"])
+)
+TOOL_SECONDS = REGISTRY.register(
+    Histogram("drone_tool_seconds", "Duration of agent tool calls", ["tool", "state"])
+)
+STEPS = REGISTRY.register(
+    Counter("drone_steps_total", "DroneAgent steps by state and outcome", ["state", "outcome"])
+)
+OPENAI_REQUESTS = REGISTRY.register(
+    Counter("drone_openai_requests_total", "Requests sent to the OpenAI API", ["call", "state"])
+)
+OPENAI_TOKENS = REGISTRY.register(
+    Counter(
+        "drone_openai_tokens_total",
+        "Tokens used by OpenAI API requests by kind (input_cached, input_uncached, output)",
+        ["call", "state", "kind"],
+    )
+)
+FLEET_WAIT_SECONDS = REGISTRY.register(
+    Histogram(
+        "drone_fleet_wait_seconds",
+        "Time requests waited for the fleet rate limit, by state of the drone",
+        ["state"],
+    )
+)
+FLEET_GRANTS = REGISTRY.register(
+    Counter("drone_fleet_grants_total", "Requests let through by the fleet scheduler", ["state"])
+)
+SCENE_FRAMES = REGISTRY.register(
+    Counter(
+        "drone_scene_frames_total",
+        "Patrol frames by scene change decision (first, changed, keepalive, unchanged)",
+        ["decision"],
+    )
+)
+JOURNAL_ERRORS = REGISTRY.register(
+    Counter(
+        "emergency_journal_errors_total",
+        "Failed commits of the emergency journal, the writes are retried",
+        [],
+    )
+)
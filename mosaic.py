@@ -0,0 +1,111 @@
+import math
+from typing import Any, List, NamedTuple, Tuple
+
+from PIL import Image, ImageDraw
+
+
+class MosaicLayout(NamedTuple):
+    rows: int
+    cols: int
+    count: int  # Number of tiles actually filled with frames
+    tile_size: Tuple[int, int]
+
+
+def build_mosaic(frames: List[Image.Image], tile_width: int = 640) -> Tuple[Image.Image, MosaicLayout]:
+    """Tile frames row by row into one image, each tile labeled with its frame number
+
+    Args:
+        frames: PIL Image objects, all tiles get the aspect ratio of the first one
+        tile_width: Width of a single tile in pixels
+
+    Returns:
+        Tuple[Image.Image, MosaicLayout]: The mosaic and the layout to map coordinates back
+    """
+    cols = math.ceil(math.sqrt(len(frames)))
+    rows = math.ceil(len(frames) / cols)
+    first_width, first_height = frames[0].size
+    tile_size = (tile_width, round(tile_width * first_height / first_width))
+
+    mosaic = Image.new("RGB", (cols * tile_size[0], rows * tile_size[1]))
+    draw = ImageDraw.Draw(mosaic)
+    for index, frame in enumerate(frames):
+        left = (index % cols) * tile_size[0]
+        top = (index // cols) * tile_size[1]
+        mosaic.paste(frame.convert("RGB").resize(tile_size, Image.BILINEAR), (left, top))
+        draw.rectangle(
+            (left, top, left + tile_size[0] - 1, top + tile_size[1] - 1),
+            outline=(255, 255, 0),
+            width=2,
+        )
+        draw.rectangle((left, top, left + 40, top + 24), fill=(0, 0, 0))
+        draw.text((left + 6, top + 6), f"#{index + 1}", fill=(255, 255, 0))
+
+    return mosaic, MosaicLayout(rows=rows, cols=cols, count=len(frames), tile_size=tile_size)
+
+
+def mosaic_legend(layout: MosaicLayout) -> str:
+    """Describe the grid so the vision model can tell the frames apart"""
+    tiles = ", ".join(
+        f"#{index + 1} at row {index // layout.cols + 1} column {index % layout.cols + 1}"
+        for index in range(layout.count)
+    )
+    return (
+        f"This image is a mosaic of {layout.count} separate drone camera frames "
+        f"in a grid of {layout.rows} rows and {layout.cols} columns, separated by yellow borders "
+        f"and labeled in their top-left corner: {tiles}. "
+        "Give coordinates normalized by the width and height of the whole mosaic."
+    )
+
+
+def _to_tile(value: float, offset: int, count: int) -> float:
+    """Normalized mosaic coordinate to a coordinate within the tile at offset"""
+    return min(max(value * count - offset, 0.0), 1.0)
+
+
+def mosaic_to_frame(x: float, y: float, layout: MosaicLayout) -> Tuple[int, float, float]:
+    """Map normalized mosaic coordinates to a frame
+
+    Args:
+        x: X coordinate normalized by the mosaic width
+        y: Y coordinate normalized by the mosaic height
+        layout: Layout returned by build_mosaic
+
+    Returns:
+        Tuple[int, float, float]: 1-based frame number and normalized (x, y) within that frame
+    """
+    col = min(int(x * layout.cols), layout.cols - 1)
+    row = min(int(y * layout.rows), layout.rows - 1)
+    index = min(row * layout.cols + col, layout.count - 1)
+    return index + 1, _to_tile(x, col, layout.cols), _to_tile(y, row, layout.rows)
+
+
+def remap_detections(detections: List[Any], layout: MosaicLayout) -> Tuple[List[int], List[Any]]:
+    """Map detections on a mosaic to the frames they were found in
+
+    Args:
+        detections: Detections with normalized x, y and bbox on the mosaic
+        layout: Layout returned by build_mosaic
+
+    Returns:
+        Tuple[List[int], List[Any]]: 1-based frame number of every detection and
+            copies of the detections with frame-local coordinates
+    """
+    frames = []
+    remapped = []
+    for detection in detections:
+        frame, x, y = mosaic_to_frame(detection.x, detection.y, layout)
+        col = (frame - 1) % layout.cols
+        row = (frame - 1) // layout.cols
+
+        box = detection.bbox
+        bbox = box.model_copy(
+            update={
+                "x_min": _to_tile(box.x_min, col, layout.cols),
+                "y_min": _to_tile(box.y_min, row, layout.rows),
+                "x_max": _to_tile(box.x_max, col, layout.cols),
+                "y_max": _to_tile(box.y_max, row, layout.rows),
+            }
+        )
+        frames.append(frame)
+        remapped.append(detection.model_copy(update={"x": x, "y": y, "bbox": bbox}))
+    return frames, remapped
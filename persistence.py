@@ -0,0 +1,157 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, List
+
+from metrics import JOURNAL_ERRORS
+
+# SQLite database of the emergencies, empty to keep them in memory only
+EMERGENCY_DB = os.getenv("EMERGENCY_DB", "emergencies.db")
+
+# Upper bound on the writes committed in one transaction
+BATCH_SIZE = 512
+
+# Seconds before a failed commit is retried, doubled after every failure
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 5.0
+# Commits attempted on close before the writes still failing are given up
+CLOSE_ATTEMPTS = 5
+
+_STOP = object()
+
+
+class EmergencyJournal:
+    """Durable copy of the emergency store in SQLite, written off the request path.
+
+    The database runs in WAL mode: the main file is the snapshot and the
+    write-ahead log its tail, which SQLite checkpoints on its own. Saves are
+    queued and a writer thread commits everything queued so far in one
+    transaction, so under load many writes share one commit. A commit that
+    fails is retried with backoff, with the writes queued meanwhile added to
+    it, until it succeeds or the journal is closed.
+    """
+
+    def __init__(self, path: str = EMERGENCY_DB, batch_size: int = BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.commits = 0
+        self.errors = 0
+        conn = self._connect()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS emergencies (id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        # Queued saves are committed before the interpreter exits
+        atexit.register(self.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL survives application crashes, only a power loss
+        # can lose the last commits
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def save(self, emergency: Any) -> None:
+        """Queue the current state of an emergency to be written"""
+        # Serialized now, the emergency may change before it is written
+        self._queue.put((emergency.id, emergency.model_dump_json()))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="emergency-journal", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        conn = self._connect()
+        # Writes not committed yet, the newest state of each emergency
+        rows = {}
+        # Queue items in rows, done once rows are committed
+        taken = 0
+        stop = False
+        attempts = 0
+        delay = RETRY_DELAY
+        while True:
+            if not stop:
+                # Wait for a write unless a failed commit is being retried
+                batch = [] if rows else [self._queue.get()]
+                # Everything queued meanwhile goes into the same transaction
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = _STOP in batch
+                taken += len(batch)
+                rows.update(item for item in batch if item is not _STOP)
+
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO emergencies (id, data) VALUES (?, ?)",
+                        rows.items(),
+                    )
+            except sqlite3.Error as e:
+                self.errors += 1
+                JOURNAL_ERRORS.inc()
+                attempts += 1
+                if not (stop and attempts >= CLOSE_ATTEMPTS):
+                    print(f"Error writing {len(rows)} emergencies, retrying in {delay:.2f} s: {str(e)}")
+                    time.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+                    continue
+                print(f"Error writing emergencies, {len(rows)} not saved: {str(e)}")
+            else:
+                self.written += len(rows)
+                self.commits += 1
+            rows = {}
+            attempts = 0
+            delay = RETRY_DELAY
+            for _ in range(taken):
+                self._queue.task_done()
+            taken = 0
+            if stop:
+                conn.close()
+                return
+
+    def flush(self) -> None:
+        """Wait until every queued save is committed, failed commits are retried"""
+        self._queue.join()
+
+    def close(self) -> None:
+        """Commit the queued saves and stop the writer thread
+
+        Saves that still fail after CLOSE_ATTEMPTS commits are given up.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def load(self) -> List[str]:
+        """JSON of every saved emergency, by id"""
+        conn = self._connect()
+        try:
+            return [data for (data,) in conn.execute("SELECT data FROM emergencies ORDER BY id")]
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "written": self.written,
+            "commits": self.commits,
+            "errors": self.errors,
+            "queued": self._queue.unfinished_tasks,
+        }
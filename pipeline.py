@@ -0,0 +1,48 @@
+import asyncio
+from typing import Any
+
+
+class LatestSlot:
+    """Hand-off between two pipeline stages that holds at most one item.
+
+    Putting an item while the previous one was not taken yet replaces it,
+    so the consumer always gets the newest item and stale ones are dropped.
+    Must be used from the event loop the consumer runs on.
+    """
+
+    def __init__(self):
+        self._item: Any = None
+        self._has_item = asyncio.Event()
+        self._empty = asyncio.Event()
+        self._empty.set()
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, item: Any) -> None:
+        if self._has_item.is_set():
+            self.dropped += 1
+        self._item = item
+        self.received += 1
+        self._has_item.set()
+        self._empty.clear()
+
+    async def get(self) -> Any:
+        await self._has_item.wait()
+        item, self._item = self._item, None
+        self._has_item.clear()
+        self._empty.set()
+        return item
+
+    async def wait_empty(self) -> None:
+        """Wait until the consumer has taken the current item"""
+        await self._empty.wait()
+
+    def depth(self) -> int:
+        return 1 if self._has_item.is_set() else 0
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "received": self.received,
+            "dropped": self.dropped,
+        }
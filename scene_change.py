@@ -0,0 +1,137 @@
+import os
+import time
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+from metrics import SCENE_FRAMES
+
+# Frames are compared as grayscale thumbnails of this size
+THUMBNAIL_SIZE = (64, 48)
+
+# Mean absolute pixel difference, 0-1, at which a frame counts as changed
+DIFFERENCE_THRESHOLD = float(os.getenv("SCENE_DIFFERENCE_THRESHOLD", "0.04"))
+
+# The thumbnail is split into BLOCKS x BLOCKS blocks compared by histogram,
+# a frame counts as changed when enough blocks changed, e.g. a car drove in
+BLOCKS = 4
+HISTOGRAM_BINS = 16
+BLOCK_THRESHOLD = float(os.getenv("SCENE_BLOCK_THRESHOLD", "0.25"))
+CHANGED_BLOCKS_THRESHOLD = float(os.getenv("SCENE_CHANGED_BLOCKS_THRESHOLD", "0.125"))
+
+# A frame is analyzed at least this often in seconds, even if nothing changed
+KEEPALIVE_INTERVAL = float(os.getenv("SCENE_KEEPALIVE_INTERVAL", "5"))
+
+
+class SceneChange(NamedTuple):
+    analyze: bool
+    reason: str  # "first", "changed", "keepalive" or "unchanged"
+    difference: float  # Mean absolute difference to the last analyzed frame, 0-1
+    changed_blocks: float  # Fraction of blocks whose histogram changed
+
+
+def _thumbnail(image: Image.Image) -> np.ndarray:
+    small = image.convert("L").resize(THUMBNAIL_SIZE, Image.BILINEAR, reducing_gap=2.0)
+    return np.asarray(small, dtype=np.float32) / 255.0
+
+
+def _block_histograms(thumbnail: np.ndarray) -> np.ndarray:
+    """Normalized histogram of every block, shape (BLOCKS * BLOCKS, HISTOGRAM_BINS)"""
+    height, width = thumbnail.shape
+    blocks = thumbnail.reshape(BLOCKS, height // BLOCKS, BLOCKS, width // BLOCKS)
+    blocks = blocks.transpose(0, 2, 1, 3).reshape(BLOCKS * BLOCKS, -1)
+    bins = np.minimum((blocks * HISTOGRAM_BINS).astype(np.int32), HISTOGRAM_BINS - 1)
+    # Offset the bins of every block so one bincount builds all histograms
+    offsets = np.arange(BLOCKS * BLOCKS)[:, None] * HISTOGRAM_BINS
+    counts = np.bincount((bins + offsets).ravel(), minlength=BLOCKS * BLOCKS * HISTOGRAM_BINS)
+    return counts.reshape(BLOCKS * BLOCKS, HISTOGRAM_BINS) / blocks.shape[1]
+
+
+class SceneChangeDetector:
+    """Decides whether a camera frame differs enough from the last analyzed one.
+
+    Frames are compared with the last frame that was let through, not the
+    previous one, so a slow drift still adds up to a change. A frame is
+    let through at least every keepalive_interval seconds regardless.
+    """
+
+    def __init__(
+        self,
+        difference_threshold: float = DIFFERENCE_THRESHOLD,
+        block_threshold: float = BLOCK_THRESHOLD,
+        changed_blocks_threshold: float = CHANGED_BLOCKS_THRESHOLD,
+        keepalive_interval: float = KEEPALIVE_INTERVAL,
+    ):
+        self.difference_threshold = difference_threshold
+        self.block_threshold = block_threshold
+        self.changed_blocks_threshold = changed_blocks_threshold
+        self.keepalive_interval = keepalive_interval
+        self._reference: np.ndarray | None = None
+        self._reference_histograms: np.ndarray | None = None
+        self._last_analyzed = 0.0
+        self._started = time.monotonic()
+        self.frames = 0
+        self.skipped = 0
+        self.keepalives = 0
+
+    def check(self, image: Image.Image) -> SceneChange:
+        """Compare a frame with the last analyzed one, which it replaces if let through
+
+        Args:
+            image: PIL Image object of the camera frame
+
+        Returns:
+            SceneChange: Whether the frame is worth a vision call and why
+        """
+        now = time.monotonic()
+        thumbnail = _thumbnail(image)
+        histograms = _block_histograms(thumbnail)
+        self.frames += 1
+
+        if self._reference is None:
+            reason, difference, changed_blocks = "first", 1.0, 1.0
+        else:
+            difference = float(np.mean(np.abs(thumbnail - self._reference)))
+            # Half the L1 distance of two normalized histograms is between 0 and 1
+            distances = np.abs(histograms - self._reference_histograms).sum(axis=1) / 2
+            changed_blocks = float(np.mean(distances > self.block_threshold))
+
+            if (
+                difference >= self.difference_threshold
+                or changed_blocks >= self.changed_blocks_threshold
+            ):
+                reason = "changed"
+            elif now - self._last_analyzed >= self.keepalive_interval:
+                reason = "keepalive"
+                self.keepalives += 1
+            else:
+                reason = "unchanged"
+
+        SCENE_FRAMES.inc(decision=reason)
+        if reason == "unchanged":
+            self.skipped += 1
+            return SceneChange(False, reason, difference, changed_blocks)
+
+        self._reference = thumbnail
+        self._reference_histograms = histograms
+        self._last_analyzed = now
+        return SceneChange(True, reason, difference, changed_blocks)
+
+    def reset(self) -> None:
+        """Forget the reference frame, the next frame is always let through"""
+        self._reference = None
+        self._reference_histograms = None
+
+    def stats(self) -> dict:
+        """Frame counts and the rate of frames let through per second"""
+        analyzed = self.frames - self.skipped
+        elapsed = time.monotonic() - self._started
+        return {
+            "frames": self.frames,
+            "analyzed": analyzed,
+            "skipped": self.skipped,
+            "keepalives": self.keepalives,
+            "skip_rate": self.skipped / self.frames if self.frames else 0.0,
+            "calls_per_second": analyzed / elapsed if elapsed else 0.0,
+        }
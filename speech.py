@@ -0,0 +1,167 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import queue
+import tempfile
+import threading
+from typing import Iterable
+
+from playsound import playsound
+
+from fleet import estimate_tokens
+from llm_client import get_async_client, request_slot
+
+TTS_MODEL = os.getenv("TTS_MODEL", "tts-1")
+TTS_VOICE = os.getenv("TTS_VOICE", "alloy")
+
+# Synthesized phrases, named after a hash of model, voice and text
+SPEECH_CACHE_DIR = os.getenv("SPEECH_CACHE_DIR", "speech_cache")
+
+# Instructions the agents give often, synthesized ahead of time by warm()
+STANDARD_MESSAGES = [
+    "Stay back, help is on the way.",
+    "Emergency services have been notified.",
+    "Please keep your distance from the scene.",
+    "Please clear the road for emergency vehicles.",
+    "If you are injured, stay still and wait for help.",
+]
+
+
+class SpeechCache:
+    """Text-to-speech phrases cached on disk by content hash.
+
+    The same phrase is synthesized once and then played from its file.
+    Every phrase gets its own file, so concurrent messages never overwrite
+    each other.
+    """
+
+    def __init__(
+        self,
+        directory: str = SPEECH_CACHE_DIR,
+        model: str = TTS_MODEL,
+        voice: str = TTS_VOICE,
+    ):
+        self.directory = directory
+        self.model = model
+        self.voice = voice
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, message: str) -> str:
+        key = hashlib.sha256(f"{self.model}\0{self.voice}\0{message}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    async def get(self, message: str) -> str:
+        """Path of the audio file of message, synthesized if it is not cached yet"""
+        path = self.path_for(message)
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+
+        self.misses += 1
+        async with request_slot(estimate_tokens(message)):
+            response = await get_async_client().audio.speech.create(
+                model=self.model,
+                voice=self.voice,
+                input=message,
+                response_format="mp3",
+            )
+        audio = response.content
+
+        os.makedirs(self.directory, exist_ok=True)
+        await asyncio.to_thread(_write_file, path, audio)
+        return path
+
+    async def warm(self, messages: Iterable[str] = STANDARD_MESSAGES) -> None:
+        """Synthesize the given phrases ahead of time, failures are only logged"""
+        results = await asyncio.gather(
+            *(self.get(message) for message in messages), return_exceptions=True
+        )
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            print(f"Could not pre-warm {len(failed)} speech phrases: {failed[0]}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def _write_file(path: str, data: bytes) -> None:
+    # Write to a temporary file first, readers never see a partial file and
+    # concurrent misses of the same phrase each write their own
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(partial, path)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+
+class AudioPlayer:
+    """Plays audio files one after another on a background thread.
+
+    Messages are queued as futures of their file path, so a message waits
+    for its synthesis on the player thread and never blocks the agent.
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[concurrent.futures.Future]" = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self.played = 0
+        self.failed = 0
+
+    def _run(self) -> None:
+        while True:
+            future = self._queue.get()
+            try:
+                playsound(future.result())
+                self.played += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error playing audio message: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def enqueue(self, path: concurrent.futures.Future) -> None:
+        """Queue a file for playback, played after all files queued before it"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audio-player", daemon=True)
+                self._thread.start()
+        self._queue.put(path)
+
+    def pending(self) -> int:
+        """Number of messages queued or playing"""
+        return self._queue.unfinished_tasks
+
+    def join(self) -> None:
+        """Wait until every queued message was played"""
+        self._queue.join()
+
+
+# Shared by all agents of the process, so drones do not talk over each other
+speech_cache = SpeechCache()
+audio_player = AudioPlayer()
+
+
+def say(message: str) -> concurrent.futures.Future:
+    """Queue a spoken message, must be called on a running event loop
+
+    Args:
+        message: Text to speak
+
+    Returns:
+        concurrent.futures.Future: Resolves to the audio file path
+    """
+    loop = asyncio.get_running_loop()
+    path = asyncio.run_coroutine_threadsafe(speech_cache.get(message), loop)
+    audio_player.enqueue(path)
+    return path
@@ -0,0 +1,146 @@
+import datetime
+import random
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import emergency_server
+import emergency_store
+from emergency_server import Emergency, Location
+from emergency_store import EmergencyStore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = EmergencyStore()
+    monkeypatch.setattr(emergency_server, "store", store)
+    return store
+
+
+def _report(intervention_id, drone_id="drone-0", x=0.5, y=0.5, emergency_type="fire"):
+    return emergency_server.report_emergency(
+        intervention_id=intervention_id,
+        drone_id=drone_id,
+        emergency_type=emergency_type,
+        location={"x": x, "y": y},
+        severity=3,
+    )
+
+
+def test_reports_of_one_intervention_merge(store):
+    first, merged = _report(7)
+    assert not merged
+    second, merged = _report(7, x=0.52)
+    assert merged
+    assert second.id == first.id
+    assert second.reports == 2
+    assert len(store) == 1
+
+
+def test_reports_of_other_interventions_do_not_merge(store):
+    earlier, _ = _report(-1)
+    report, merged = _report(7)
+    assert not merged
+    assert report.id != earlier.id
+
+    # Each intervention resolves the emergencies it reported
+    assert emergency_server.resolve_emergency(7) == 1
+    assert store.get(report.id).status == "RESOLVED"
+    assert store.get(earlier.id).status == "IN_PROGRESS"
+
+
+def test_reports_of_other_drones_do_not_merge(store):
+    first, _ = _report(7, drone_id="drone-0")
+    second, merged = _report(7, drone_id="drone-1")
+    assert not merged
+    assert second.id != first.id
+    assert len(store) == 2
+
+
+def test_aware_timestamps_are_stored_as_local_time(store):
+    client = TestClient(emergency_server.app)
+    report = {
+        "key": "drone-0/run/7/1",
+        "intervention_id": 7,
+        "emergency_type": "fire",
+        "location": {"x": 0.5, "y": 0.5},
+        "severity": 3,
+        "timestamp": "2025-01-01T00:00:00Z",
+    }
+    response = client.post("/emergencies:batch", json={"reports": [report]})
+    assert response.status_code == 200
+
+    emergency = store.get(response.json()["results"][0]["id"])
+    assert emergency.timestamp.tzinfo is None
+    response = client.get("/emergencies", params={"since": "2024-12-31T00:00:00Z"})
+    assert [em["id"] for em in response.json()] == [emergency.id]
+
+
+def _emergency(store, rng, intervention_id):
+    return Emergency(
+        id=store.next_id(),
+        intervention_id=intervention_id,
+        emergency_type=rng.choice(["fire", "car_crash", "other"]),
+        location=Location(x=rng.random(), y=rng.random()),
+        status="IN_PROGRESS",
+        severity=rng.randint(1, 5),
+        timestamp=datetime.datetime(2025, 1, 1) + datetime.timedelta(minutes=rng.randrange(10_000)),
+        changelog=[],
+    )
+
+
+def test_snapshots_stay_consistent_under_concurrent_writes(monkeypatch):
+    # Small pages and overlays, so the writes cross many pages and compactions
+    monkeypatch.setattr(emergency_store, "PAGE_SIZE", 4)
+    monkeypatch.setattr(emergency_store, "OVERLAY_LIMIT", 8)
+    store = EmergencyStore()
+    rng = random.Random(0)
+    for i in range(400):
+        store.add(_emergency(store, rng, i // 4))
+    writing = threading.Event()
+    writing.set()
+    failures = []
+
+    def write():
+        rng = random.Random(1)
+        try:
+            for _ in range(2_000):
+                if rng.random() < 0.3:
+                    store.report(_emergency(store, rng, rng.randrange(150)))
+                else:
+                    for em in store.by_intervention(rng.randrange(150)):
+                        store.set_status(em.id, rng.choice(["RESOLVED", "IN_PROGRESS"]))
+        finally:
+            writing.clear()
+
+    def read(seed):
+        rng = random.Random(seed)
+        try:
+            while writing.is_set():
+                snapshot = store.snapshot()
+                status = rng.choice([None, "IN_PROGRESS", "RESOLVED"])
+                sort = rng.choice(["-timestamp", "severity"])
+                page, _ = snapshot.query(status=status, sort=sort, limit=500)
+                assert all(status is None or em.status == status for em in page)
+                keys = [emergency_store._sort_key(em, sort) for em in page]
+                assert keys == sorted(keys, reverse=sort.startswith("-"))
+                # Later writes do not show through a snapshot taken earlier
+                assert snapshot.query(status=status, sort=sort, limit=500)[0] == page
+                intervention = rng.randrange(150)
+                emergencies = snapshot.by_intervention(intervention)
+                assert all(em.intervention_id == intervention for em in emergencies)
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=write)]
+    threads += [threading.Thread(target=read, args=(seed,)) for seed in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert failures == []
+    assert store.compactions > 0
+    for em in store.query(limit=500)[0]:
+        assert store.get(em.id) is em
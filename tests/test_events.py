@@ -0,0 +1,56 @@
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+
+import emergency_server
+from events import CREATED, EventGap, EventLog
+
+
+class Change(BaseModel):
+    id: int
+
+
+def _publish(log: EventLog, count: int) -> None:
+    for i in range(count):
+        log.publish(CREATED, Change(id=i))
+
+
+def test_resume_within_run():
+    log = EventLog()
+    _publish(log, 5)
+    seq = log.parse_id(log.event_id(3))
+    assert [event.seq for event in log.since(seq)] == [4, 5]
+
+
+def test_ids_of_an_earlier_run_are_rejected():
+    before = EventLog()
+    _publish(before, 3)
+    last_seen = before.event_id(before.seq)
+
+    # The restarted server numbers its events from 1 again and passes the old id
+    after = EventLog()
+    _publish(after, 5)
+    with pytest.raises(EventGap):
+        after.parse_id(last_seen)
+    assert after.parse_id("0") == 0
+
+
+def test_changes_after_restart_is_gone(monkeypatch):
+    before = EventLog()
+    _publish(before, 3)
+    monkeypatch.setattr(emergency_server, "events", EventLog())
+    _publish(emergency_server.events, 5)
+    client = TestClient(emergency_server.app)
+
+    response = client.get("/emergencies/changes", params={"since": before.event_id(3)})
+    assert response.status_code == 410
+
+    response = client.get("/emergencies/changes", params={"since": "0"})
+    assert response.status_code == 200
+    assert response.json()["seq"] == emergency_server.events.event_id(5)
+    assert len(response.json()["changes"]) == 5
+
+
+def test_invalid_event_id():
+    client = TestClient(emergency_server.app)
+    assert client.get("/emergencies/changes", params={"since": "3"}).status_code == 400
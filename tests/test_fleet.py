@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import pytest
+
+from fleet import FleetScheduler, TokenBucket
+
+
+def _empty_bucket(per_minute: float, capacity: float) -> TokenBucket:
+    bucket = TokenBucket(per_minute, capacity)
+    bucket.tokens = 0.0
+    bucket.updated = 100.0
+    return bucket
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = _empty_bucket(per_minute=60, capacity=10)
+    assert bucket.wait_time(1, now=100.0) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now=100.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1, now=101.0) == 0.0
+    assert bucket.tokens == pytest.approx(1.0)
+
+
+def test_bucket_refills_up_to_its_capacity():
+    bucket = _empty_bucket(per_minute=60, capacity=10)
+    assert bucket.wait_time(10, now=1_000.0) == 0.0
+    assert bucket.tokens == 10
+    bucket.refund(5)
+    assert bucket.tokens == 10
+
+
+def test_request_larger_than_the_bucket_waits_for_a_full_bucket():
+    bucket = _empty_bucket(per_minute=60, capacity=10)
+    assert bucket.wait_time(50, now=100.0) == pytest.approx(10.0)
+    assert bucket.wait_time(50, now=110.0) == 0.0
+
+
+def test_usage_above_the_estimate_is_charged():
+    bucket = _empty_bucket(per_minute=60, capacity=10)
+    assert bucket.wait_time(5, now=105.0) == 0.0
+    # The request used 3 tokens more than it was granted
+    bucket.refund(-3)
+    assert bucket.wait_time(5, now=105.0) == pytest.approx(3.0)
+
+
+async def _grant_order(scheduler: FleetScheduler, requests: list) -> list:
+    """Drone and state of the requests in the order the scheduler granted them"""
+    granted = []
+
+    async def request(drone_id, state):
+        await scheduler.acquire(drone_id, state, tokens=100)
+        granted.append((drone_id, state))
+
+    await asyncio.gather(*(request(drone_id, state) for drone_id, state in requests))
+    return granted
+
+
+def _contended_scheduler() -> FleetScheduler:
+    # One request every 50 ms, none available when the requests arrive
+    scheduler = FleetScheduler(requests_per_minute=1_200)
+    scheduler.requests.tokens = 0.0
+    scheduler.requests.updated = time.monotonic()
+    return scheduler
+
+
+def test_higher_priority_states_are_served_first():
+    requests = [
+        ("drone-0", "PATROL"),
+        ("drone-1", "INVESTIGATION"),
+        ("drone-2", "PATROL"),
+        ("drone-3", "EMERGENCY_HANDLING"),
+    ]
+    granted = asyncio.run(_grant_order(_contended_scheduler(), requests))
+    assert [state for _, state in granted] == [
+        "EMERGENCY_HANDLING",
+        "INVESTIGATION",
+        "PATROL",
+        "PATROL",
+    ]
+
+
+def test_drones_of_one_priority_take_turns():
+    requests = [("drone-0", "PATROL")] * 3 + [("drone-1", "PATROL")]
+    granted = asyncio.run(_grant_order(_contended_scheduler(), requests))
+    assert [drone_id for drone_id, _ in granted] == ["drone-0", "drone-1", "drone-0", "drone-0"]
@@ -0,0 +1,68 @@
+import json
+import sqlite3
+
+import persistence
+from persistence import EmergencyJournal
+
+
+class Saved:
+    def __init__(self, id: int, status: str = "IN_PROGRESS"):
+        self.id = id
+        self.status = status
+
+    def model_dump_json(self) -> str:
+        return json.dumps({"id": self.id, "status": self.status})
+
+
+class FailingConnection:
+    """Connection whose first writes fail, like those to a locked database"""
+
+    def __init__(self, conn: sqlite3.Connection, failures: int):
+        self.conn = conn
+        self.failures = failures
+
+    def __enter__(self):
+        return self.conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.conn.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def executemany(self, sql, rows):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        return self.conn.executemany(sql, rows)
+
+
+def _journal(tmp_path, monkeypatch, failures: int) -> EmergencyJournal:
+    monkeypatch.setattr(persistence, "RETRY_DELAY", 0.001)
+    journal = EmergencyJournal(str(tmp_path / "emergencies.db"))
+    connect = journal._connect
+    monkeypatch.setattr(journal, "_connect", lambda: FailingConnection(connect(), failures))
+    return journal
+
+
+def test_failed_commits_are_retried(tmp_path, monkeypatch):
+    journal = _journal(tmp_path, monkeypatch, failures=3)
+    journal.save(Saved(1))
+    journal.save(Saved(2))
+    journal.save(Saved(1, "RESOLVED"))
+    journal.flush()
+
+    assert journal.errors == 3
+    assert journal.stats()["queued"] == 0
+    saved = [json.loads(data) for data in journal.load()]
+    assert saved == [{"id": 1, "status": "RESOLVED"}, {"id": 2, "status": "IN_PROGRESS"}]
+    journal.close()
+
+
+def test_close_gives_up_on_writes_that_keep_failing(tmp_path, monkeypatch):
+    journal = _journal(tmp_path, monkeypatch, failures=1_000)
+    journal.save(Saved(1))
+    journal.close()
+
+    assert journal.errors >= persistence.CLOSE_ATTEMPTS
+    assert journal.load() == []
@@ -0,0 +1,61 @@
+import io
+import os
+import threading
+from typing import Dict
+
+from PIL import Image
+
+from blob_store import BlobStore, blob_store
+
+# Longest side in pixels of the previews shown on the dashboard cards
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "160"))
+
+THUMBNAIL_QUALITY = 70
+
+
+class ThumbnailCache:
+    """Small JPEG previews of stored images, rendered once per image.
+
+    Thumbnails are stored in the blob store next to the images, so they are
+    served and revalidated like any other blob. The image to thumbnail
+    mapping is kept in memory, after a restart the first request renders
+    the thumbnail again and the blob store finds it already stored.
+    """
+
+    def __init__(self, blobs: BlobStore = blob_store, size: int = THUMBNAIL_SIZE):
+        self.blobs = blobs
+        self.size = size
+        self._lock = threading.Lock()
+        self._refs: Dict[str, str] = {}
+        self.rendered = 0
+        self.hits = 0
+
+    def get(self, ref: str) -> str:
+        """Blob reference of the thumbnail of the image blob ref, rendered if needed"""
+        with self._lock:
+            thumbnail = self._refs.get(ref)
+            if thumbnail is not None:
+                self.hits += 1
+                return thumbnail
+
+        # Rendered outside the lock, two concurrent renders store the same blob
+        with Image.open(io.BytesIO(self.blobs.read(ref))) as image:
+            # Lets the JPEG decoder skip most of the pixels
+            image.draft("RGB", (self.size, self.size))
+            preview = image.convert("RGB")
+        preview.thumbnail((self.size, self.size), Image.BILINEAR)
+        buffer = io.BytesIO()
+        preview.save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+        thumbnail = self.blobs.put(buffer.getvalue())
+
+        with self._lock:
+            self._refs[ref] = thumbnail
+            self.rendered += 1
+        return thumbnail
+
+    def stats(self) -> dict:
+        return {"rendered": self.rendered, "hits": self.hits}
+
+
+# Thumbnails of the emergency images
+thumbnails = ThumbnailCache()
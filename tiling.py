@@ -0,0 +1,134 @@
+from typing import Any, List, Tuple
+
+# Normalized (left, top, right, bottom) of a tile within the analyzed image
+Box = Tuple[float, float, float, float]
+
+# Fraction of a tile shared with its neighbour, so objects on a border are
+# fully visible in at least one tile
+TILE_OVERLAP = 0.15
+
+# Detections of the same category overlapping more than this, relative to the
+# smaller box, are treated as the same object seen by two tiles
+MERGE_OVERLAP = 0.5
+
+
+def tile_boxes(grid: int, overlap: float = TILE_OVERLAP) -> List[Box]:
+    """Split the unit square into grid x grid overlapping tiles, row by row"""
+    # Tiles of this size with the given overlap exactly cover the image
+    size = 1.0 / (grid - (grid - 1) * overlap)
+    step = size * (1.0 - overlap)
+    boxes = []
+    for row in range(grid):
+        for col in range(grid):
+            left = min(col * step, 1.0 - size)
+            top = min(row * step, 1.0 - size)
+            boxes.append((left, top, min(left + size, 1.0), min(top + size, 1.0)))
+    return boxes
+
+
+def crop_pixels(box: Box, size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """Pixel crop box of a normalized box in an image of the given size"""
+    width, height = size
+    return (
+        round(box[0] * width),
+        round(box[1] * height),
+        round(box[2] * width),
+        round(box[3] * height),
+    )
+
+
+def _to_image(value: float, start: float, end: float) -> float:
+    return start + min(max(value, 0.0), 1.0) * (end - start)
+
+
+def remap_tile_detections(detections: List[Any], box: Box) -> List[Any]:
+    """Copies of detections on a tile with coordinates normalized by the whole image
+
+    Args:
+        detections: Detections with normalized x, y and bbox on the tile
+        box: Normalized box of the tile, one of tile_boxes
+
+    Returns:
+        List[Any]: Remapped copies of the detections
+    """
+    left, top, right, bottom = box
+    remapped = []
+    for detection in detections:
+        bbox = detection.bbox.model_copy(
+            update={
+                "x_min": _to_image(detection.bbox.x_min, left, right),
+                "y_min": _to_image(detection.bbox.y_min, top, bottom),
+                "x_max": _to_image(detection.bbox.x_max, left, right),
+                "y_max": _to_image(detection.bbox.y_max, top, bottom),
+            }
+        )
+        remapped.append(
+            detection.model_copy(
+                update={
+                    "x": _to_image(detection.x, left, right),
+                    "y": _to_image(detection.y, top, bottom),
+                    "bbox": bbox,
+                }
+            )
+        )
+    return remapped
+
+
+def _area(bbox) -> float:
+    return max(bbox.x_max - bbox.x_min, 0.0) * max(bbox.y_max - bbox.y_min, 0.0)
+
+
+def _overlap(a, b) -> float:
+    """Intersection over the area of the smaller box, so a part of an object
+    cut by a tile border matches the whole object"""
+    width = min(a.x_max, b.x_max) - max(a.x_min, b.x_min)
+    height = min(a.y_max, b.y_max) - max(a.y_min, b.y_min)
+    if width <= 0 or height <= 0:
+        return 0.0
+    smaller = min(_area(a), _area(b))
+    return width * height / smaller if smaller > 0 else 1.0
+
+
+def merge_detections(detections: List[Any], threshold: float = MERGE_OVERLAP) -> List[Any]:
+    """Merge detections of the same object found in several tiles
+
+    Detections are taken by descending confidence. One that overlaps an
+    already kept detection of the same category is merged into it: the kept
+    box grows to cover both and its center moves to the middle of the box.
+
+    Args:
+        detections: Detections with coordinates normalized by the whole image
+        threshold: Overlap relative to the smaller box at which two detections merge
+
+    Returns:
+        List[Any]: Merged detections, most confident first
+    """
+    kept: List[Any] = []
+    for detection in sorted(detections, key=lambda d: d.confidence, reverse=True):
+        for i, other in enumerate(kept):
+            if other.category != detection.category:
+                continue
+            if _overlap(other.bbox, detection.bbox) < threshold:
+                continue
+
+            a, b = other.bbox, detection.bbox
+            bbox = a.model_copy(
+                update={
+                    "x_min": min(a.x_min, b.x_min),
+                    "y_min": min(a.y_min, b.y_min),
+                    "x_max": max(a.x_max, b.x_max),
+                    "y_max": max(a.y_max, b.y_max),
+                }
+            )
+            kept[i] = other.model_copy(
+                update={
+                    "bbox": bbox,
+                    "x": (bbox.x_min + bbox.x_max) / 2,
+                    "y": (bbox.y_min + bbox.y_max) / 2,
+                    "text": other.text or detection.text,
+                }
+            )
+            break
+        else:
+            kept.append(detection)
+    return kept